@@ -14,6 +14,9 @@ from mayavi import mlab
 mlab.options.offscreen = True
 
 USE_GPU = False
+# Initialize each case of the node convergence studies from the solution of
+# the previous (coarser) case.
+WARM_START = False
 
 
 fontsize=32
@@ -27,6 +30,17 @@ def figure():
     matplotlib.rc('font', **font)
 
 
+def _warm_start(cases):
+    '''Make each case start from the model of the previous case when
+    WARM_START is set.
+    '''
+    if WARM_START:
+        for prev, case in zip(cases, cases[1:]):
+            case.params['init_from'] = prev.input_path('model.pt')
+            case.depends.append(prev)
+    return cases
+
+
 def _plot_1d(problem, left_bdy=True, right_bdy=True):
     problem.make_output_dir()
     for case in problem.cases:
@@ -958,6 +972,7 @@ class Poisson2DSineNodes(Problem):
             )
             for n in (25, 50, 75, 100)
         ]
+        _warm_start(self.cases)
 
     def run(self):
         _plot_pde_conv_nodes(self)
@@ -1040,6 +1055,7 @@ class SquareSlit(Problem):
             )
             for n in (25, 50, 100, 200, 500)
         ]
+        _warm_start(self.cases)
 
     def run(self):
         self.make_output_dir()
@@ -1231,7 +1247,53 @@ class Cavity(Problem):
         self.plot_comparison()
 
 
+def load_series(case, prefix='series'):
+    '''Return the times and a dict of memory mapped arrays of the time
+    series store of an FD case or None if it has no such store.
+    '''
+    tfile = Path(case.input_path(f'{prefix}_t.npy'))
+    if not tfile.exists():
+        return None
+    t = np.load(str(tfile), mmap_mode='r')
+    n = np.count_nonzero(~np.isnan(t))
+    arrays = {}
+    for f in Path(case.input_path()).glob(f'{prefix}_*.npy'):
+        name = f.name[len(prefix) + 1:-4]
+        if name != 't':
+            arrays[name] = np.load(str(f), mmap_mode='r')[:n]
+    return t[:n], arrays
+
+
+def _get_series_results(series, times):
+    t, arrays = series
+    result = []
+    models = []
+    for time in times:
+        i = min(np.searchsorted(t, time - 1e-10), len(t) - 1)
+        assert abs(t[i] - time) < 1e-10, "Insufficient output data?"
+        result.append(dict(
+            x=arrays['x'][i], y=arrays['y'][i],
+            y_exact=arrays['y_exact'][i], t=t[i], iter=arrays['iter'][i]
+        ))
+        models.append({
+            k: torch.from_numpy(np.array(v[i])) for k, v in arrays.items()
+            if k.startswith('layer')
+        })
+    return result, models
+
+
+def _first_model(case):
+    series = load_series(case)
+    if series is not None:
+        return _get_series_results(series, series[0][:1])[1][0]
+    pth = sorted(Path(case.input_path()).glob('model_*.pt'))
+    return torch.load(str(pth[0]))
+
+
 def get_results(case, times):
+    series = load_series(case)
+    if series is not None:
+        return _get_series_results(series, times)
     files = sorted(Path(case.input_path()).glob('results_*.npz'))
     mfiles = sorted(Path(case.input_path()).glob('model_*.pt'))
     data = [np.load(str(f)) for f in files]
@@ -1328,8 +1390,7 @@ class BurgersFD(Problem):
         fname = os.path.join('code', 'data', 'pyclaw_burgers1d_sine2.npz')
         exact = np.load(fname)
         for case in self.cases:
-            pth = sorted(Path(case.input_path()).glob('model_*.pt'))
-            nn_state = torch.load(str(pth[0]))
+            nn_state = _first_model(case)
             nodes = self._n_nodes(nn_state)
             self._plot_solution(case, nodes, exact)
 
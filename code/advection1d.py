@@ -6,8 +6,8 @@ import numpy as np
 import torch
 
 from common import tensor
-from ibvp2d_base import IBVP2D
-from spinn2d import Plotter2D, SPINN2D, App2D
+from ibvp2d_base import IBVP2D, IBVPApp2D
+from spinn2d import Plotter2D, SPINN2D
 
 
 class Advection1D(IBVP2D):
@@ -16,7 +16,7 @@ class Advection1D(IBVP2D):
         return cls(args.nodes, args.samples,
                    args.b_nodes, args.b_samples,
                    args.xL, args.xR, args.T,
-                   args.ic, args.sample_frac)
+                   args.ic, args.sample_frac, args.sampler)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -29,8 +29,9 @@ class Advection1D(IBVP2D):
         )
 
     def __init__(self, n, ns, nb=None, nbs=None,
-                 xL=0.0, xR=1.0, T=1.0, ic='gaussian', sample_frac=1.0):
-        super().__init__(n, ns, nb, nbs, xL, xR, T, sample_frac)
+                 xL=0.0, xR=1.0, T=1.0, ic='gaussian', sample_frac=1.0,
+                 sampler='grid'):
+        super().__init__(n, ns, nb, nbs, xL, xR, T, sample_frac, sampler)
         self.ic = ic
 
     def pde(self, x, t, u, ux, ut, uxx, utt):
@@ -57,12 +58,8 @@ class Advection1D(IBVP2D):
             y = np.heaviside(z, 0.5) - np.heaviside(z - 1.0, 0.5)
             return y*np.sin(z*np.pi*2)
 
-    def boundary_loss(self, nn):
-        xb, tb = self.boundary()
-        u = nn(xb, tb)
-        ub = self.exact(xb.detach().cpu().numpy(), tb.detach().cpu().numpy())
-        bc = u - tensor(ub)
-        return (bc**2).sum()
+    def boundary_value(self, x, t):
+        return self.exact(x, t)
 
 
 class MyPlotter(Plotter2D):
@@ -78,7 +75,7 @@ class MyPlotter(Plotter2D):
         uex_p = self.pde.exact(xp, yp)
         x, t = np.mgrid[-1:1:200j, 0:1:11j]
         xt, tt = tensor(x.ravel()), tensor(t.ravel())
-        u = nn(xt, tt).detach().cpu().numpy()
+        u = self.evaluator(xt, tt).cpu().numpy()
         u.shape = x.shape
         u_exact = self.pde.exact(x, t)
         np.savez(rfile, x=x, t=t, u=u, u_exact=u_exact,
@@ -86,7 +83,7 @@ class MyPlotter(Plotter2D):
 
 
 if __name__ == '__main__':
-    app = App2D(
+    app = IBVPApp2D(
         pde_cls=Advection1D,
         nn_cls=SPINN2D,
         plotter_cls=MyPlotter
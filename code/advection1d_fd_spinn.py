@@ -9,8 +9,9 @@ from fd_spinn1d_base import FDSPINN1D, AppFD1D, FDPlotter1D
 
 
 class Advection1D(FDSPINN1D):
-    def __init__(self, n, ns, sample_frac=1.0, dt=1e-3, T=1.0, t_skip=10):
-        super().__init__(n, ns, sample_frac, dt=dt, T=T, t_skip=t_skip)
+    def __init__(self, n, ns, sample_frac=1.0, dt=1e-3, T=1.0, t_skip=10,
+                 **kw):
+        super().__init__(n, ns, sample_frac, dt=dt, T=T, t_skip=t_skip, **kw)
 
         self.xn = np.asarray([-1.0 + 2*i/(n + 1) for i in range(1, (n + 1))])
         self.xs = tensor(
@@ -20,16 +21,16 @@ class Advection1D(FDSPINN1D):
 
         self.xbn = np.array([-1.0, 1.0])
         self.xb = tensor(self.xbn)
-        self.u0 = self.initial(self.xs)
+        self.u0 = self.c = self.initial(self.xs)
 
     def initial(self, x):
         z = (x + 0.3)/0.15
         u0 = torch.exp(-0.5*z**2)
         return u0
 
-    def pde(self, x, u, ux, uxx, u0, dt):
+    def rhs(self, x, u, ux, uxx):
         a = 0.5
-        return -dt*a*ux - u + u0
+        return -a*ux
 
     def has_exact(self):
         return True
@@ -39,11 +40,11 @@ class Advection1D(FDSPINN1D):
         z = (x - a*self.t + 0.3)/0.15
         return np.exp(-0.5*z**2)
 
-    def boundary_loss(self, nn):
+    def boundary_residuals(self, nn):
         u = nn(self.boundary())
         ub = 0.0
         bc = u - ub
-        return 100*(bc**2).sum()
+        return 10*bc
 
     def plot_points(self):
         n = min(2*self.ns, 500)
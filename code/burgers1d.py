@@ -6,8 +6,8 @@ import numpy as np
 import torch
 
 from common import tensor
-from ibvp2d_base import IBVP2D
-from spinn2d import Plotter2D, SPINN2D, App2D
+from ibvp2d_base import IBVP2D, IBVPApp2D
+from spinn2d import Plotter2D, SPINN2D
 
 
 class Burgers1D(IBVP2D):
@@ -17,7 +17,7 @@ class Burgers1D(IBVP2D):
                    args.b_nodes, args.b_samples,
                    args.xL, args.xR, args.T,
                    args.ic, args.viscosity,
-                   args.sample_frac)
+                   args.sample_frac, args.sampler)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -35,8 +35,9 @@ class Burgers1D(IBVP2D):
         )
 
     def __init__(self, n, ns, nb=None, nbs=None, xL=0.0, xR=1.0, T=1.0,
-                 ic='gaussian', viscosity=0.0, sample_frac=1.0):
-        super().__init__(n, ns, nb, nbs, xL, xR, T, sample_frac)
+                 ic='gaussian', viscosity=0.0, sample_frac=1.0,
+                 sampler='grid'):
+        super().__init__(n, ns, nb, nbs, xL, xR, T, sample_frac, sampler)
         self.ic = ic
         self.viscosity = viscosity
 
@@ -45,15 +46,14 @@ class Burgers1D(IBVP2D):
 
     def interior_loss(self, nn):
         res = self._get_residue(nn)
-        r = (res**2).mean()
+        r = self.sample_weighted(res**2).mean()
         return r
 
     def has_exact(self):
         return False
 
     def _get_residue_plot(self, nn, xs, ys):
-        u = nn(xs, ys)
-        u, ux, uy, uxx, uyy = self._compute_derivatives(u, xs, ys)
+        u, ux, uy, uxx, uyy = self._eval_derivatives(nn, xs, ys)
         res = self.pde(xs, ys, u, ux, uy, uxx, uyy)
         return res
 
@@ -74,15 +74,8 @@ class Burgers1D(IBVP2D):
             y = np.heaviside(z, 0.5) - np.heaviside(z - 1.0, 0.5)
             return y*np.sin(z*np.pi*2)
 
-    def boundary_loss(self, nn):
-        xb, tb = self.boundary()
-        u = nn(xb, tb)
-        ub = self._boundary_condition(
-            xb.detach().cpu().numpy(), tb.detach().cpu().numpy()
-        )
-        bc = u - tensor(ub)
-        l = (bc**2).sum()
-        return l
+    def boundary_value(self, x, t):
+        return self._boundary_condition(x, t)
 
 
 class MyPlotter(Plotter2D):
@@ -96,14 +89,14 @@ class MyPlotter(Plotter2D):
         rfile = os.path.join(dirname, 'results.npz')
         x, t = np.mgrid[-1:1:500j, 0:1:11j]
         xt, tt = tensor(x.ravel()), tensor(t.ravel())
-        u = nn(xt, tt).detach().cpu().numpy()
+        u = self.evaluator(xt, tt).cpu().numpy()
         u.shape = x.shape
         xp, tp, up = self.get_plot_data()
         np.savez(rfile, x=x, t=t, u=u, xp=xp, tp=tp, up=up)
 
 
 if __name__ == '__main__':
-    app = App2D(
+    app = IBVPApp2D(
         pde_cls=Burgers1D,
         nn_cls=SPINN2D,
         plotter_cls=MyPlotter
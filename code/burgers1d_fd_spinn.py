@@ -12,17 +12,17 @@ class Burgers1D(FDSPINN1D):
         u0 = torch.sin(2.0*np.pi*x)
         return u0
 
-    def pde(self, x, u, ux, uxx, u0, dt):
-        return -dt*u*ux - u + u0
+    def rhs(self, x, u, ux, uxx):
+        return -u*ux
 
     def has_exact(self):
         return False
 
-    def boundary_loss(self, nn):
+    def boundary_residuals(self, nn):
         u = nn(self.boundary())
         ub = 0.0
         bc = u - ub
-        return 100*(bc**2).sum()
+        return 10*bc
 
     def plot_points(self):
         n = min(2*self.ns, 500)
@@ -5,12 +5,14 @@ import torch
 import torch.autograd as ag
 
 from common import tensor
+from samplers import box_points
 from spinn2d import Plotter2D, App2D, SPINN2D
 from pde2d_base import RegularPDE
 
 
 class CavityPDE(RegularPDE):
-    def __init__(self, n_nodes, ns, nb=None, nbs=None, sample_frac=1.0):
+    def __init__(self, n_nodes, ns, nb=None, nbs=None, sample_frac=1.0,
+                 sampler='grid'):
         self.sample_frac = sample_frac
 
         # Interior nodes
@@ -36,8 +38,11 @@ class CavityPDE(RegularPDE):
         self.ns = ns = round(np.sqrt(ns) + 0.49)
         dxb2 = 1.0/(ns)
         xl, xr = dxb2, 1.0 - dxb2
-        sl = slice(xl, xr, ns*1j)
-        x, y = np.mgrid[sl, sl]
+        if sampler == 'grid':
+            sl = slice(xl, xr, ns*1j)
+            x, y = np.mgrid[sl, sl]
+        else:
+            x, y = box_points(ns*ns, (0.0, 0.0), (1.0, 1.0), sampler)
         xs, ys = (tensor(t.ravel(), requires_grad=True)
                   for t in (x, y))
         self.p_samples = (xs, ys)
@@ -78,26 +83,41 @@ class CavityPDE(RegularPDE):
     def has_exact(self):
         return False
 
-    def interior_loss(self, nn):
+    def _get_residue(self, nn):
         xs, ys = self.interior()
-        U = nn(xs, ys)
-        u = U[:, 0]
-        v = U[:, 1]
-        p = U[:, 2]
-        u, ux, uy, uxx, uyy = self._compute_derivatives(u, xs, ys)
-        v, vx, vy, vxx, vyy = self._compute_derivatives(v, xs, ys)
-        px, py = self._compute_gradient(p, xs, ys)
+        closed_form = getattr(nn, 'closed_form', False)
+        if closed_form or self.diff_backend != 'autograd':
+            U, Ux, Uy, Uxx, Uyy = self._eval_derivatives(nn, xs, ys)
+            u, v = U[:, 0], U[:, 1]
+            ux, vx, px = Ux.T
+            uy, vy, py = Uy.T
+            uxx, vxx = Uxx[:, 0], Uxx[:, 1]
+            uyy, vyy = Uyy[:, 0], Uyy[:, 1]
+        else:
+            U = nn(xs, ys)
+            u = U[:, 0]
+            v = U[:, 1]
+            p = U[:, 2]
+            u, ux, uy, uxx, uyy = self._compute_derivatives(u, xs, ys)
+            v, vx, vy, vxx, vyy = self._compute_derivatives(v, xs, ys)
+            px, py = self._compute_gradient(p, xs, ys)
 
         # The NS equations.
         nu = 0.01
-        ce = ((ux + vy)**2).sum()
-        mex = ((u*ux + v*uy + px - nu*(uxx + uyy))**2).sum()
-        mey = ((u*vx + v*vy + py - nu*(vxx + vyy))**2).sum()
+        ce = ux + vy
+        mex = u*ux + v*uy + px - nu*(uxx + uyy)
+        mey = u*vx + v*vy + py - nu*(vxx + vyy)
+        return torch.stack((ce, mex, mey), dim=1)
+
+    def interior_loss(self, nn):
+        res = self._get_residue(nn)
+        return self.sample_weighted((res**2).sum(dim=1)).sum()
 
-        return ce + (mex + mey)
+    def interior_residuals(self, nn):
+        return self.sample_root_weighted(self._get_residue(nn), mean=False)
 
-    def boundary_loss(self, nn):
-        bc_weight = self.ns*20
+    def boundary_residuals(self, nn):
+        bc_weight = np.sqrt(self.ns*20)
         xb, yb = self.boundary()
         Ub = nn(xb, yb)
         ub = Ub[:, 0]
@@ -106,13 +126,10 @@ class CavityPDE(RegularPDE):
         pbx, pby = self._compute_gradient(pb, xb, yb)
 
         n_top = len(self.top[0])
-        ub_top = ub[:n_top]
-        bc_loss = ((ub_top - 1.0)**2).sum()
-        bc_loss += (ub[n_top:]**2).sum()*bc_weight
-        bc_loss += ((vb)**2).sum()*bc_weight
-        bc_loss += (pby[:2*n_top]**2).sum()
-        bc_loss += (pbx[2*n_top:]**2).sum()
-        return bc_loss
+        return torch.cat((
+            ub[:n_top] - 1.0, ub[n_top:]*bc_weight, vb*bc_weight,
+            pby[:2*n_top], pbx[2*n_top:]
+        ))
 
     def plot_points(self):
         n = min(self.ns*2, 200)
@@ -123,9 +140,7 @@ class CavityPDE(RegularPDE):
 class CavityPlotter(Plotter2D):
 
     def get_plot_data(self):
-        x, y = self.pde.plot_points()
-        xt, yt = tensor(x.ravel()), tensor(y.ravel())
-        pn = self.nn(xt, yt).detach().cpu().numpy()
+        (x, y), pn = self.evaluator.solution()
         pn.shape = x.shape + (3,)
         return x, y, pn
 
@@ -185,7 +200,7 @@ class CavityPlotter(Plotter2D):
         midc = tensor(0.5*np.ones(100))
         xc = torch.cat((lc, midc))
         yc = torch.cat((midc, lc))
-        data = self.nn(xc, yc).detach().cpu().numpy()
+        data = self.evaluator(xc, yc).cpu().numpy()
         vc = data[:, 1][:100]
         uc = data[:, 0][100:]
 
@@ -1,12 +1,24 @@
+import contextlib
 import os
+import queue
+import sys
+import threading
 import time
 
 import numpy as np
 import torch
+import torch.autograd as ag
 import torch.optim as optim
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
+from samplers import BatchSampler
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 _device = torch.device("cpu")
 
@@ -28,7 +40,681 @@ def tensor(x, **kw):
     return torch.tensor(x, dtype=torch.float32, device=device(), **kw)
 
 
+def func_derivatives(nn, *xs):
+    '''Return the output of `nn` at the points `xs` along with its first
+    derivatives and the diagonal of its Hessian with respect to each
+    coordinate, i.e. (u, u_x, u_y, ..., u_xx, u_yy, ...).
+
+    This differentiates the sum of the outputs over the points in reverse
+    mode with `torch.func` (a vjp of the gradient gives the Hessian
+    diagonal) so the sample points need not require gradients.  The
+    network is assumed to act pointwise so the gradient of the sum yields
+    the per-point derivatives.  Multi-variable outputs are differentiated
+    per component.  Nested forward mode (jvp over jvp) avoids the sums but
+    was several times slower than this for our networks.
+    '''
+    xs = tuple(x.detach() for x in xs)
+    # Fit the range of any kernel tables to the points and build them
+    # before entering the transforms.
+    tables = [
+        m.table for m in nn.modules()
+        if isinstance(getattr(m, 'table', None), KernelTable)
+    ] if isinstance(nn, torch.nn.Module) else []
+    if tables:
+        with torch.no_grad():
+            nn(*xs)
+        for table in tables:
+            table._get_table()
+    argnums = tuple(range(len(xs)))
+
+    def _gradient(k):
+        def _sum(*z):
+            u = nn(*z)
+            return (u if u.dim() == 1 else u[:, k]).sum(), u
+        return torch.func.grad(_sum, argnums=argnums, has_aux=True)
+
+    du, d2u = [], []
+    k, n_out = 0, 1
+    while k < n_out:
+        g, vjp_fn, u = torch.func.vjp(_gradient(k), *xs, has_aux=True)
+        n_out = 1 if u.dim() == 1 else u.shape[1]
+        du.append(g)
+        d2u.append(tuple(
+            vjp_fn(tuple(
+                torch.ones_like(gj) if j == i else torch.zeros_like(gj)
+                for j, gj in enumerate(g)
+            ))[i]
+            for i in argnums
+        ))
+        k += 1
+    if u.dim() == 1:
+        return (u, *du[0], *d2u[0])
+    du = [torch.stack(d, dim=1) for d in zip(*du)]
+    d2u = [torch.stack(d, dim=1) for d in zip(*d2u)]
+    return (u, *du, *d2u)
+
+
+def removal_change(z, w, use_pu=False):
+    '''Return the root mean square change of the solution over the points
+    when each node is removed by itself, given the values `z` of the basis
+    functions of the n nodes at the m points as an (m, n) tensor and the
+    (n, n_vars) output weights `w`.
+
+    Without a partition of unity this is the contribution w_j z_j of the
+    node.  With one the solution is u = sum_j w_j psi_j where psi_j =
+    z_j/sum(z) and removing node j changes it by psi_j (u - w_j)/(1 - psi_j),
+    which is small wherever w_j is close to the solution and not where w_j
+    is small.
+    '''
+    w = w.unsqueeze(0)
+    if use_pu:
+        psi = (z/z.sum(dim=1, keepdim=True)).unsqueeze(2)
+        u = (psi*w).sum(dim=1, keepdim=True)
+        eps = torch.finfo(z.dtype).eps
+        d = psi*(u - w)/torch.clamp(1.0 - psi, min=eps)
+    else:
+        d = z.unsqueeze(2)*w
+    return d.pow(2).sum(dim=2).mean(dim=0).sqrt()
+
+
+def resize_parameter(param, index, new=None, dim=0, optimizer=None):
+    '''Resize `param` in place along `dim` so that its i'th entry is the
+    old entry `index[i]`, or the next entry of `new` (zero if not given)
+    where `index[i]` is negative.
+
+    The optimizer state for the parameter is remapped in the same way so
+    training can continue without restarting the optimizer.  State that
+    cannot be remapped (like the flattened history of LBFGS) is discarded.
+    '''
+    keep = index >= 0
+    pos = torch.nonzero(keep).squeeze(1)
+    pos_new = torch.nonzero(~keep).squeeze(1)
+
+    def _remap(old, fill=None):
+        shape = list(old.shape)
+        shape[dim] = len(index)
+        out = old.new_zeros(shape)
+        out.index_copy_(dim, pos, old.index_select(dim, index[keep]))
+        if fill is not None:
+            out.index_copy_(dim, pos_new, fill.to(out))
+        return out
+
+    if optimizer is not None:
+        state = optimizer.state.get(param, {})
+        for key, value in list(state.items()):
+            if not torch.is_tensor(value) or value.dim() == 0:
+                continue
+            if value.shape == param.shape:
+                state[key] = _remap(value)
+            else:
+                state.clear()
+                break
+        if hasattr(optimizer, '_numel_cache'):
+            optimizer._numel_cache = None
+    # Swapping keeps the identity of the parameter (so the optimizer still
+    # refers to it) while resetting its autograd metadata for the new shape.
+    value = _remap(param.detach(), new)
+    torch.utils.swap_tensors(
+        param, torch.nn.Parameter(value, requires_grad=param.requires_grad)
+    )
+
+
+def gradient_hessian(loss, params):
+    '''Return the gradient and Hessian of `loss` with respect to the
+    flattened `params` (detached).
+    '''
+    grads = ag.grad(loss, params, create_graph=True)
+    g = torch.cat([x.flatten() for x in grads])
+    n = len(g)
+    eye = torch.eye(n, dtype=g.dtype, device=g.device)
+    rows = ag.grad(g, params, eye, is_grads_batched=True)
+    H = torch.cat([x.reshape(n, -1) for x in rows], dim=1)
+    return g.detach(), H.detach()
+
+
+def jacobian(r, params, chunk=1024):
+    '''Return the Jacobian of the vector `r` with respect to the flattened
+    `params` (detached), computed `chunk` rows at a time.
+    '''
+    m = len(r)
+    rows = []
+    for i in range(0, m, chunk):
+        k = min(chunk, m - i)
+        v = torch.zeros(k, m, dtype=r.dtype, device=r.device)
+        v[torch.arange(k), torch.arange(i, i + k)] = 1.0
+        grads = ag.grad(
+            r, params, v, retain_graph=True, is_grads_batched=True,
+            allow_unused=True
+        )
+        rows.append(torch.cat([
+            (g if g is not None else v.new_zeros((k,) + p.shape)).reshape(
+                k, -1
+            )
+            for g, p in zip(grads, params)
+        ], dim=1).detach())
+    return torch.cat(rows)
+
+
+def graph_size(t):
+    '''Return the number of autograd nodes in the graph of the tensor `t`
+    and the bytes of the tensors they saved for backward.  Tensors sharing
+    storage are only counted once.
+    '''
+    seen, storages = set(), set()
+    n_bytes = 0
+    stack = [t.grad_fn] if t.grad_fn is not None else []
+    while stack:
+        fn = stack.pop()
+        if fn in seen:
+            continue
+        seen.add(fn)
+        for name in dir(fn):
+            if not name.startswith('_saved_'):
+                continue
+            try:
+                value = getattr(fn, name)
+            except RuntimeError:
+                continue
+            values = value if isinstance(value, (tuple, list)) else (value,)
+            for v in values:
+                if not torch.is_tensor(v):
+                    continue
+                try:
+                    storage = v.untyped_storage()
+                    key = (v.device, storage.data_ptr())
+                    size = storage.nbytes()
+                except RuntimeError:
+                    # Tensors wrapped by torch.func have no storage.
+                    key = id(v)
+                    size = v.numel()*v.element_size()
+                if key not in storages:
+                    storages.add(key)
+                    n_bytes += size
+        stack.extend(f for f, _ in fn.next_functions if f is not None)
+    return len(seen), n_bytes
+
+
+def add_to_parameters(params, dp):
+    '''Add the flattened update `dp` to the `params` in place.'''
+    dp = dp.to(device=params[0].device, dtype=params[0].dtype)
+    with torch.no_grad():
+        offset = 0
+        for p in params:
+            p += dp[offset:offset + p.numel()].view_as(p)
+            offset += p.numel()
+
+
+def minimize_quadratic(loss, params):
+    '''Update `params` in place to the minimizer of `loss`, which is assumed
+    to be a quadratic function of them, using a single Newton step with the
+    exact Hessian.  For least squares losses this solves the normal
+    equations; the solve is done in double precision with singular values
+    below the precision of `loss` discarded.
+    '''
+    g, H = gradient_hessian(loss, params)
+    rcond = torch.finfo(g.dtype).eps
+    dw = torch.linalg.lstsq(
+        H.double().cpu(), g.double().cpu().unsqueeze(1), rcond=rcond,
+        driver='gelsd'
+    ).solution
+    add_to_parameters(params, -dw.squeeze(1))
+
+
+def _has_no_storage(x):
+    try:
+        x.data_ptr()
+    except RuntimeError:
+        return True
+    return False
+
+
+# torch does not expose a public test for the tensors wrapped by the
+# torch.func transforms.  Use the private one where it exists and fall back
+# to the wrappers having no storage of their own otherwise.
+_is_functorch_wrapped = getattr(
+    getattr(torch._C, '_functorch', None), 'is_functorch_wrapped_tensor',
+    _has_no_storage
+)
+
+
+def is_transformed(x):
+    '''Return True if `x` is being transformed by `torch.func`.'''
+    return _is_functorch_wrapped(x)
+
+
+def load_resized(module, state):
+    '''Load the `state` dict into `module` allowing the parameters and
+    buffers to change shape.  Entries missing in `state` are left as is.
+    '''
+    with torch.no_grad():
+        for name, value in state.items():
+            mod_name, _, attr = name.rpartition('.')
+            mod = module.get_submodule(mod_name)
+            getattr(mod, attr).data = value.to(device(), copy=True)
+
+
+class KernelTable:
+    '''Tabulate a scalar function of one variable on a uniform grid over
+    [lo, hi] and evaluate it by quintic Hermite interpolation of its values,
+    slopes and curvatures at the table points.  This is twice continuously
+    differentiable so the second derivatives needed by the PDEs remain
+    accurate.  The coefficients of the quintic on each interval are stored
+    and it is evaluated in Horner form, summing the Hermite basis functions
+    instead loses precision in the second derivative to cancellation.  The
+    range is grown (and the table rebuilt) whenever an input falls outside
+    it since learned kernels need not decay.  The range can only be checked
+    outside of `torch.func` transforms, inside them the inputs are clamped
+    to the table.
+
+    The table is kept in the autograd graph so gradients flow back to the
+    parameters of the tabulated function through the table values.  It is
+    rebuilt whenever one of the parameters returned by `params()` is
+    modified (for example by an optimizer step) or replaced (for example by
+    `torch.func.functional_call`) or when it was built without gradients
+    and they are now required.  Tables built from transformed parameters
+    are not kept.
+    '''
+    def __init__(self, func, params, lo, hi, size=256):
+        self.func = func
+        self.params = params
+        self.size = size
+        self._set_range(lo, hi)
+
+    def _set_range(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+        self.dx = (hi - lo)/(self.size - 1)
+        self._version = None
+        self._table = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_version=None, _table=None)
+        return state
+
+    def _build(self):
+        # The derivatives use forward mode so that the table can also be
+        # built inside the torch.func transforms.
+        grad = torch.is_grad_enabled()
+        with torch.inference_mode(False):
+            x = torch.linspace(self.lo, self.hi, self.size, device=device())
+            ones = torch.ones_like(x)
+
+            def _first(z):
+                return torch.func.jvp(self.func, (z,), (ones,))
+
+            (f, df), (_, d2f) = torch.func.jvp(_first, (x,), (ones,))
+        dx = self.dx
+        m, c = df*dx, d2f*dx*dx
+        df1 = f[1:] - f[:-1]
+        m0, m1, c0, c1 = m[:-1], m[1:], c[:-1], c[1:]
+        table = (
+            f[:-1], m0, 0.5*c0,
+            10.0*df1 - 6.0*m0 - 4.0*m1 - 1.5*c0 + 0.5*c1,
+            -15.0*df1 + 8.0*m0 + 7.0*m1 + 1.5*c0 - c1,
+            6.0*df1 - 3.0*(m0 + m1) - 0.5*(c0 - c1)
+        )
+        if not grad:
+            table = tuple(t.detach() for t in table)
+        return table
+
+    def _get_table(self):
+        params = list(self.params())
+        if any(is_transformed(p) for p in params):
+            return self._build()
+        version = tuple((id(p), p._version) for p in params)
+        stale = (
+            self._table is None or version != self._version or
+            (torch.is_grad_enabled() and not self._table[0].requires_grad)
+        )
+        if stale:
+            self._table = self._build()
+            self._version = version
+        return self._table
+
+    def _check_range(self, x):
+        '''Grow the range of the table to include the values `x`.'''
+        xmin, xmax = (v.item() for v in torch.aminmax(x.detach()))
+        if xmin < self.lo or xmax > self.hi:
+            width = self.hi - self.lo
+            self._set_range(
+                min(self.lo, xmin - 0.1*width), max(self.hi, xmax + 0.1*width)
+            )
+
+    def __call__(self, x):
+        if not is_transformed(x):
+            self._check_range(x)
+        t = torch.clamp((x - self.lo)/self.dx, 0.0, self.size - 1.0)
+        k = torch.clamp(t.detach().floor().long(), 0, self.size - 2)
+        s = t - k
+        a0, a1, a2, a3, a4, a5 = (a[k] for a in self._get_table())
+        return a0 + s*(a1 + s*(a2 + s*(a3 + s*(a4 + s*a5))))
+
+
+class SnapshotWriter:
+    '''Run output jobs (serialization and disk I/O) on a background thread.
+
+    Jobs are queued in a bounded queue so `submit` blocks if the writer falls
+    too far behind.  `close` waits for all the queued jobs to be written.  An
+    error in a job is raised on the next call to `submit` or `close`.
+    '''
+    def __init__(self, maxsize=8):
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            func, args, kw = job
+            try:
+                func(*args, **kw)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, func, *args, **kw):
+        self._check()
+        self.queue.put((func, args, kw))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+
+class TimeSeriesStore:
+    '''Append snapshots of named arrays to preallocated, memory mapped .npy
+    files in `dirname`, one file per name called `prefix_<name>.npy` with
+    the snapshots along the first axis.
+
+    The times are stored in `prefix_t.npy` (NaN for unused slots) and the
+    iteration numbers in `prefix_iter.npy`.  The time is written last so a
+    reader only sees complete snapshots.  Use `np.load(..., mmap_mode='r')`
+    to read them.
+    '''
+    def __init__(self, dirname, capacity, prefix='series'):
+        self.dirname = dirname
+        self.capacity = capacity
+        self.prefix = prefix
+        self.count = 0
+        self.arrays = {}
+        self.t = self._open('t', (), np.float64)
+        self.t[:] = np.nan
+        self.iter = self._open('iter', (), np.int64)
+
+    def _open(self, name, shape, dtype):
+        fname = os.path.join(self.dirname, f'{self.prefix}_{name}.npy')
+        return np.lib.format.open_memmap(
+            fname, mode='w+', dtype=dtype, shape=(self.capacity,) + shape
+        )
+
+    def append(self, t, iter, **arrays):
+        if self.count == self.capacity:
+            raise RuntimeError('Time series store is full.')
+        i = self.count
+        for name, value in arrays.items():
+            value = np.asarray(value)
+            if name not in self.arrays:
+                self.arrays[name] = self._open(name, value.shape, value.dtype)
+            arr = self.arrays[name]
+            if arr.shape[1:] != value.shape:
+                raise ValueError(
+                    f'Shape of {name} changed from {arr.shape[1:]} to '
+                    f'{value.shape}.'
+                )
+            arr[i] = value
+        self.iter[i] = iter
+        self.t[i] = t
+        self.count += 1
+
+    def close(self):
+        for arr in list(self.arrays.values()) + [self.iter, self.t]:
+            arr.flush()
+
+
+class MetricRecorder:
+    '''Record scalar tensors without synchronizing with the device.
+
+    The values are written to a preallocated device buffer of `size`
+    entries which is only copied to the host by `flush` (or when it is
+    full).  With `keep` > 0 only the last `keep` values are kept on the host
+    so that long runs use bounded memory.  `numpy.asarray` gives all the
+    recorded (and kept) values.
+    '''
+    def __init__(self, size=100, keep=0):
+        self.size = max(size, 1)
+        self.keep = keep
+        self.buf = None
+        self.count = 0
+        self.n_flushed = 0
+        self._host = []
+
+    def append(self, value):
+        if not torch.is_tensor(value):
+            value = tensor(value)
+        if self.buf is None:
+            self.buf = torch.empty(
+                self.size, dtype=value.dtype, device=value.device
+            )
+        if self.count == self.size:
+            self.flush()
+        self.buf[self.count] = value.detach()
+        self.count += 1
+
+    def flush(self):
+        '''Copy the buffered values to the host and return them.'''
+        if self.count == 0:
+            return np.empty(0)
+        values = self.buf[:self.count].cpu().numpy().astype(float)
+        self.count = 0
+        self.n_flushed += len(values)
+        self._host.append(values)
+        if self.keep > 0 and sum(len(x) for x in self._host) > self.keep:
+            self._host = [np.concatenate(self._host)[-self.keep:]]
+        return values
+
+    def values(self):
+        self.flush()
+        if not self._host:
+            return np.empty(0)
+        return np.concatenate(self._host)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values()
+        return values if dtype is None else values.astype(dtype)
+
+    def __len__(self):
+        return self.n_flushed + self.count
+
+
+class PhaseTimer:
+    '''Accumulate the wall clock time and the number of calls of the phases
+    of the training loop.
+
+    Phases nest and each is only charged its own time, i.e. without that of
+    the phases called from it.  Phases called from an `opaque` phase are
+    charged to it.  On the GPU the times are those seen by the host unless
+    `sync` is set, which synchronizes the device at every phase boundary.
+    With `trace` set each phase is also labelled in the torch profiler.
+    '''
+    opaque = ('errors', 'adapt')
+
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.trace = False
+        self.times = {}
+        self.calls = {}
+        self.iterations = 0
+        self._stack = []
+        self._wrapped = []
+
+    def _now(self):
+        if self.sync and device().type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        parent = self._stack[-1] if self._stack else None
+        if parent is not None and parent[0] in self.opaque:
+            name = parent[0]
+        if self.trace:
+            label = torch.profiler.record_function(name)
+        else:
+            label = contextlib.nullcontext()
+        entry = [name, self._now(), 0.0]
+        self._stack.append(entry)
+        try:
+            with label:
+                yield
+        finally:
+            self._stack.pop()
+            elapsed = self._now() - entry[1]
+            self.times[name] = self.times.get(name, 0.0) + elapsed - entry[2]
+            if parent is None or parent[0] != name:
+                self.calls[name] = self.calls.get(name, 0) + 1
+            if parent is not None:
+                parent[2] += elapsed
+
+    def wrap(self, obj, attr, name):
+        '''Time the calls of the method `attr` of `obj` as phase `name`
+        until `unwrap` is called.
+        '''
+        func = getattr(obj, attr, None)
+        if func is None:
+            return
+        old = vars(obj).get(attr)
+
+        def wrapper(*args, **kw):
+            with self(name):
+                return func(*args, **kw)
+
+        setattr(obj, attr, wrapper)
+        self._wrapped.append((obj, attr, old))
+
+    def unwrap(self):
+        while self._wrapped:
+            obj, attr, old = self._wrapped.pop()
+            if old is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, old)
+
+    def summary(self):
+        '''Return a table of the phases as a string.'''
+        total = sum(self.times.values())
+        n_itr = max(self.iterations, 1)
+        lines = [
+            f"{'Phase':<12}{'Calls':>9}{'Calls/it':>10}{'Time (s)':>11}"
+            f"{'ms/call':>10}{'%':>7}"
+        ]
+        for name, t in sorted(self.times.items(), key=lambda x: -x[1]):
+            n = self.calls[name]
+            lines.append(
+                f"{name:<12}{n:>9d}{n/n_itr:>10.2f}{t:>11.3f}"
+                f"{1e3*t/max(n, 1):>10.3f}{100*t/max(total, 1e-300):>7.1f}"
+            )
+        lines.append(f"{'total':<12}{self.iterations:>9d}{'':>10}"
+                     f"{total:>11.3f}")
+        return '\n'.join(lines)
+
+    def save(self, fname):
+        names = sorted(self.times)
+        np.savez(
+            fname, phases=np.array(names),
+            time=np.array([self.times[x] for x in names]),
+            calls=np.array([self.calls[x] for x in names]),
+            iterations=self.iterations
+        )
+
+
+class MemoryRecorder:
+    '''Record the memory used by the training iterations.
+
+    For each recorded iteration this keeps the peak resident memory of the
+    process, the current and peak memory of the GPU tensor allocator (NaN on
+    the CPU, which has no allocator statistics) and the number of autograd
+    nodes and bytes saved for backward in the graph of the loss.  All sizes
+    are in MB.
+    '''
+    fields = ('iteration', 'rss_peak', 'alloc', 'alloc_peak', 'graph_nodes',
+              'graph_saved')
+
+    def __init__(self):
+        self.data = {k: [] for k in self.fields}
+
+    def __len__(self):
+        return len(self.data['iteration'])
+
+    @staticmethod
+    def rss_peak():
+        '''Peak resident memory of the process in MB.'''
+        if resource is None:
+            return np.nan
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kB elsewhere.
+        return rss/2**20 if sys.platform == 'darwin' else rss/2**10
+
+    def record(self, iteration, loss):
+        nodes, saved = graph_size(loss)
+        if device().type == 'cuda':
+            alloc = torch.cuda.memory_allocated()/2**20
+            alloc_peak = torch.cuda.max_memory_allocated()/2**20
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            alloc = alloc_peak = np.nan
+        values = (iteration, self.rss_peak(), alloc, alloc_peak, nodes,
+                  saved/2**20)
+        for k, v in zip(self.fields, values):
+            self.data[k].append(v)
+
+    def summary(self):
+        d = self.data
+        return (
+            f"Peak memory: resident {max(d['rss_peak']):.1f} MB, "
+            f"allocator {np.max(d['alloc_peak']):.1f} MB; "
+            f"graph: {max(d['graph_nodes'])} nodes, "
+            f"{max(d['graph_saved']):.2f} MB saved for backward"
+        )
+
+    def save(self, fname):
+        np.savez(fname, **{k: np.asarray(v) for k, v in self.data.items()})
+
+
 class PDE:
+    # The backend used to compute derivatives of the solution, either
+    # 'autograd' (nested reverse mode) or 'func' (torch.func forward mode).
+    diff_backend = 'autograd'
+
+    # Batch sampler of the interior points and its mode and seed.
+    sampler = None
+    batch_sampler = 'epoch'
+    sampler_seed = None
+
+    # Boundary targets computed by `cached_target`.
+    _target_cache = None
+
+    # Sampling of the interior points, these are set by `resample`.
+    sample_prob = None
+    sample_active = None
+    sample_reweight = False
+    sample_weight = None
+    _sample_all = False
+    # The batch drawn inside `same_batch` as (n, indices, weights).
+    _held_batch = None
+    # Changes whenever a new batch of interior samples is drawn.
+    batch_count = 0
+
     @classmethod
     def from_args(cls, args):
         pass
@@ -71,14 +757,189 @@ class PDE:
     def exact(self, *args):
         pass
 
+    def exact_key(self):
+        '''Return a value that changes whenever the exact solution at fixed
+        points does, for example the time for time dependent problems.
+        '''
+        return getattr(self, 't', None)
+
     def interior_loss(self, nn):
         raise NotImplementedError()
 
     def boundary_loss(self, nn):
+        return (self.boundary_residuals(nn)**2).sum()
+
+    def interior_residuals(self, nn):
+        '''Return the residuals whose sum of squares is the interior loss,
+        by default the mean of the squared residue.
+        '''
+        return self.sample_root_weighted(self._get_residue(nn))
+
+    def boundary_residuals(self, nn):
+        '''Return the residuals whose sum of squares is the boundary loss.
+        '''
         raise NotImplementedError()
 
+    def residuals(self, nn):
+        '''Return the vector of residuals whose sum of squares is the loss
+        (used by least squares optimizers).
+        '''
+        return torch.cat((
+            self.interior_residuals(nn).flatten(),
+            self.boundary_residuals(nn).flatten()
+        ))
+
     ###################################################################
 
+    def cached_target(self, func, *pts):
+        '''Return `func` of the numpy values of the tensors `pts` as a tensor
+        on the device.
+
+        This is computed once and reused until different tensors are passed
+        or they are modified in place, so targets like the exact solution on
+        the boundary samples are not recomputed every iteration.
+        '''
+        if self._target_cache is None:
+            self._target_cache = {}
+        versions = tuple(p._version for p in pts)
+        entry = self._target_cache.get(func)
+        if entry is not None:
+            old_pts, old_versions, value = entry
+            same = len(old_pts) == len(pts) and all(
+                a is b for a, b in zip(old_pts, pts)
+            )
+            if same and old_versions == versions:
+                return value
+        value = tensor(func(*(p.detach().cpu().numpy() for p in pts)))
+        self._target_cache[func] = (pts, versions, value)
+        return value
+
+    def sample_arrays(self, *arrays):
+        '''Return the training batch from the candidate interior samples.
+
+        The `arrays` have one entry per candidate and are all indexed by the
+        same batch.  The batch is drawn uniformly without replacement using
+        the `sample_frac` unless `resample` has set up residual based
+        sampling.
+        '''
+        self.sample_weight = None
+        n = len(arrays[0])
+        frac = getattr(self, 'sample_frac', 1.0)
+        held = self._held_batch
+        if self._sample_all:
+            return arrays
+        elif held and held[0] == n:
+            idx, self.sample_weight = held[1:]
+        elif self.sample_active is not None:
+            idx = self.sample_active
+        elif self.sample_prob is not None:
+            p = self.sample_prob
+            idx = self.get_sampler(n, max(1, int(frac*n))).weighted(p)
+            if self.sample_reweight:
+                self.sample_weight = 1.0/(n*p[idx])
+            self.batch_count += 1
+        elif abs(frac - 1.0) < 1e-3:
+            return arrays
+        else:
+            idx = self.get_sampler(n, int(frac*n)).draw()
+            self.batch_count += 1
+        if held is not None:
+            self._held_batch = (n, idx, self.sample_weight)
+        return tuple(arr[idx] for arr in arrays)
+
+    @contextlib.contextmanager
+    def same_batch(self):
+        '''Draw the interior batch once and reuse it for all the losses
+        computed inside the block.
+        '''
+        if self._held_batch is not None:
+            yield
+            return
+        self._held_batch = ()
+        try:
+            yield
+        finally:
+            self._held_batch = None
+
+    def get_sampler(self, n, size):
+        '''Return the `BatchSampler` for batches of `size` out of `n`
+        samples, a new one is made if these change.
+        '''
+        s = self.sampler
+        if s is None or s.n != n or s.size != size:
+            self.sampler = s = BatchSampler(
+                n, size, self.batch_sampler, self.sampler_seed, device()
+            )
+        return s
+
+    def sample_weighted(self, value):
+        '''Multiply the per sample `value` of the last batch by the importance
+        weights (if any) so its mean is an unbiased estimate.
+        '''
+        w = self.sample_weight
+        if w is None:
+            return value
+        return value*w.reshape((-1,) + (1,)*(value.dim() - 1))
+
+    def sample_root_weighted(self, res, mean=True):
+        '''Return the residue `res` of the last batch scaled so that its sum
+        of squares is the (mean if `mean` is set) importance weighted sum of
+        its squares.
+        '''
+        w = self.sample_weight
+        if w is not None:
+            res = res*w.sqrt().reshape((-1,) + (1,)*(res.dim() - 1))
+        return res/np.sqrt(res.numel()) if mean else res
+
+    def candidate_residue(self, nn):
+        '''Return the candidate interior samples as an (n, dim) tensor and
+        the magnitude of the residue at each of them.
+        '''
+        self._sample_all = True
+        try:
+            pts = self.interior()
+            res = self._get_residue(nn).detach()
+        finally:
+            self._sample_all = False
+        if torch.is_tensor(pts):
+            pts = (pts,)
+        pts = torch.stack([p.detach() for p in pts], dim=1)
+        res = res.reshape(len(pts), -1).abs().sum(dim=1)
+        return pts, res
+
+    def resample(self, nn, method='rad', power=1.0, floor=1.0,
+                 reweight=False, frac=0.1):
+        '''Score the candidate interior samples by their residue and update
+        how the training batch is drawn.
+
+        'rad' draws the batch with probability proportional to
+        res**power/mean(res**power) + floor and optionally reweights the
+        loss by the inverse probabilities so that it stays unbiased.  'rar'
+        keeps a set of active samples (initially a uniform subset) and adds
+        the `frac` candidates with the largest residue to it.
+        '''
+        res = self.candidate_residue(nn)[1].cpu().numpy().astype(float)
+        n = len(res)
+        if method == 'rad':
+            e = res**power
+            p = e/max(e.mean(), 1e-300) + floor
+            self.sample_prob = tensor(p/p.sum())
+            self.sample_reweight = reweight
+        elif method == 'rar':
+            active = self.sample_active
+            if active is None:
+                size = int(getattr(self, 'sample_frac', 1.0)*n)
+                active = torch.unique(self.get_sampler(n, size).draw())
+            active = active.cpu().numpy()
+            res[active] = -1.0
+            n_new = min(max(1, int(frac*len(active))), n - len(active))
+            new = np.argsort(-res)[:n_new]
+            active = np.sort(np.concatenate((active, new)))
+            self.sample_active = torch.as_tensor(active, device=device())
+            self.batch_count += 1
+        else:
+            raise ValueError(f'Unknown resampling method {method}.')
+
     def loss(self, nn):
         '''Total loss is computed by default as
            (interior loss + boundary loss)
@@ -88,14 +949,110 @@ class PDE:
         loss = loss_int + loss_bdy
         return loss
 
-    def _compute_derivatives(self, u, x):
-        raise NotImplementedError()
+    def _compute_derivatives(self, u, *xs):
+        '''Return (u, u_x, u_y, ..., u_xx, u_yy, ...) for the scalar output
+        `u` computed at the points `xs` using reverse mode autograd.
+        '''
+        du = ag.grad(
+            outputs=u, inputs=xs, grad_outputs=torch.ones_like(u),
+            retain_graph=True, create_graph=True, allow_unused=True
+        )
+        d2u = [
+            ag.grad(
+                outputs=dx, inputs=x, grad_outputs=torch.ones_like(dx),
+                retain_graph=True, create_graph=True, allow_unused=True
+            )[0]
+            for x, dx in zip(xs, du)
+        ]
+        return (u, *du, *d2u)
+
+    def _eval_derivatives(self, nn, *xs):
+        '''Return the solution and its derivatives at the given points.
+
+        Networks that can compute their derivatives analytically do so in a
+        single pass, otherwise the selected `diff_backend` is used.
+        '''
+        if getattr(nn, 'closed_form', False):
+            return nn.derivatives(*xs)
+        elif self.diff_backend == 'func':
+            return func_derivatives(nn, *xs)
+        u = nn(*xs)
+        return self._compute_derivatives(u, *xs)
+
+
+class Evaluator:
+    '''Evaluate a network in chunks of points under `torch.inference_mode`.
+
+    The plot points of the problem are kept as tensors along with the exact
+    solution there, these are only rebuilt when the points or the
+    `exact_key` of the problem change, and the errors are computed on the
+    device.  Chunking bounds the memory used for large plot grids.
+    '''
+    def __init__(self, pde, nn, chunk=4096):
+        self.pde = pde
+        self.nn = nn
+        self.chunk = chunk
+        self._coords = None
+        self._pts = None
+        self._exact = None
+        self._exact_key = None
+
+    def __call__(self, *pts):
+        '''Return the output of the network at the tensors `pts`.'''
+        n = len(pts[0])
+        size = self.chunk if self.chunk > 0 else n
+        with torch.inference_mode():
+            out = torch.cat([
+                self.nn(*(p[i:i + size] for p in pts)).reshape(
+                    min(size, n - i), -1
+                )
+                for i in range(0, n, size)
+            ])
+        return out.squeeze(1) if out.shape[1] == 1 else out
+
+    def points(self):
+        '''Return the plot points as numpy arrays and as flat tensors.'''
+        coords = self.pde.plot_points()
+        if not isinstance(coords, tuple):
+            coords = (coords,)
+        coords = tuple(
+            c.detach().cpu().numpy() if torch.is_tensor(c) else np.asarray(c)
+            for c in coords
+        )
+        old = self._coords
+        same = old is not None and len(old) == len(coords) and all(
+            a.shape == b.shape and np.array_equal(a, b)
+            for a, b in zip(old, coords)
+        )
+        if not same:
+            self._coords = coords
+            self._pts = tuple(tensor(c.ravel()) for c in coords)
+            self._exact = None
+        return tuple(c.view() for c in self._coords), self._pts
+
+    def solution(self):
+        '''Return the plot points and the solution there as numpy arrays.'''
+        coords, pts = self.points()
+        return coords, self(*pts).cpu().numpy()
+
+    def errors(self):
+        '''Return the L1, L2 and Linf errors at the plot points.'''
+        coords, pts = self.points()
+        key = self.pde.exact_key()
+        if self._exact is None or key != self._exact_key:
+            ue = np.asarray(self.pde.exact(*coords), dtype=float)
+            self._exact = torch.as_tensor(ue, device=device()).reshape(-1)
+            self._exact_key = key
+        diff = (self(*pts).reshape(-1).double() - self._exact).abs()
+        err = torch.stack((diff.mean(), diff.square().mean().sqrt(),
+                           diff.max()))
+        return tuple(err.tolist())
 
 
 class Plotter:
     @classmethod
     def from_args(cls, pde, nn, args):
-        return cls(pde, nn, args.no_show_exact)
+        return cls(pde, nn, args.no_show_exact, eval_chunk=args.eval_chunk)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -105,8 +1062,14 @@ class Plotter:
             action='store_true', default=False,
             help='Do not show exact solution even if available.'
         )
+        p.add_argument(
+            '--eval-chunk', dest='eval_chunk',
+            default=kw.get('eval_chunk', 4096), type=int,
+            help='Number of points evaluated at a time for the plots, output '
+            'and errors (0 evaluates all the points at once).'
+        )
 
-    def __init__(self, pde, nn, no_show_exact=False):
+    def __init__(self, pde, nn, no_show_exact=False, eval_chunk=4096):
         '''Initializer
 
         Parameters
@@ -116,9 +1079,11 @@ class Plotter:
         nn: Neural network for the solution
         eq: DiffEq: Differential equation to evaluate.
         no_show_exact: bool: Show exact solution or not.
+        eval_chunk: int: Number of points evaluated at a time.
         '''
         self.pde = pde
         self.nn = nn
+        self.evaluator = Evaluator(pde, nn, eval_chunk)
         self.plt1 = None
         self.plt2 = None  # For weights
         self.show_exact = not no_show_exact
@@ -151,15 +1116,90 @@ class Plotter:
         pass
 
 
+class LevenbergMarquardt(optim.Optimizer):
+    '''Levenberg-Marquardt optimizer for models with few parameters.
+
+    The closure must return the vector of residuals r whose sum of squares
+    is the loss.  Each step solves (J^T J + lambda D) dp = -J^T r where J is
+    the Jacobian of r and D the diagonal of J^T J.  The damping lambda is
+    decreased when a step reduces the loss and increased (and the step
+    retried) when it does not.  The trial steps only evaluate the residuals,
+    without tracking gradients with respect to the parameters.  `lr` is
+    accepted for compatibility with the other optimizers and is unused.
+    '''
+    def __init__(self, params, lr=None, damping=1e-3, max_tries=10):
+        defaults = dict(damping=damping, max_tries=max_tries)
+        super().__init__(params, defaults)
+
+    @staticmethod
+    def _trial_loss(closure, params):
+        # The residues may need the derivatives with respect to the points
+        # so grad mode stays on but the parameters are not tracked.
+        for p in params:
+            p.requires_grad_(False)
+        try:
+            with torch.enable_grad():
+                r = closure().detach()
+        finally:
+            for p in params:
+                p.requires_grad_(True)
+        return r.double().square().sum().item()
+
+    @torch.no_grad()
+    def step(self, closure):
+        '''Take a step and return the loss before it.'''
+        group = self.param_groups[0]
+        params = [p for p in group['params'] if p.requires_grad]
+        with torch.enable_grad():
+            r = closure()
+            J = jacobian(r, params).double()
+        r = r.detach()
+        rd = r.double()
+        g = J.T @ rd
+        A = J.T @ J
+        diag = torch.clamp(A.diagonal(), min=1e-12*A.diagonal().max().item())
+        diag = diag + 1e-30
+        lam = group['damping']
+        f0 = rd.square().sum().item()
+        for _ in range(group['max_tries']):
+            dp = -torch.linalg.lstsq(
+                (A + torch.diag(lam*diag)).cpu(), g.cpu().unsqueeze(1)
+            ).solution.squeeze(1)
+            add_to_parameters(params, dp)
+            if self._trial_loss(closure, params) < f0:
+                lam = max(lam/3.0, 1e-12)
+                break
+            add_to_parameters(params, -dp)
+            lam = min(lam*2.0, 1e12)
+        group['damping'] = lam
+        return r.square().sum()
+
+
 class Optimizer:
     @classmethod
     def from_args(cls, pde, nn, plotter, args):
-        optimizers = {'Adam': optim.Adam, 'LBFGS': optim.LBFGS}
+        optimizers = {
+            'Adam': optim.Adam, 'LBFGS': optim.LBFGS,
+            'LM': LevenbergMarquardt
+        }
         o = optimizers[args.optimizer]
         return cls(
             pde, nn, plotter, n_train=args.n_train,
             n_skip=args.n_skip, tol=args.tol, lr=args.lr,
-            plot=args.plot, out_dir=args.directory, opt_class=o
+            plot=args.plot, out_dir=args.directory, opt_class=o,
+            varpro=args.varpro, adapt_every=args.adapt_every,
+            adapt_frac=args.adapt_frac, adapt_tol=args.adapt_tol,
+            max_nodes=args.max_nodes, reuse_optimizer=args.reuse_optimizer,
+            linear_step=args.linear_step, sampling=args.sampling,
+            resample_every=args.resample_every,
+            resample_power=args.resample_power,
+            resample_floor=args.resample_floor, reweight=args.reweight,
+            rar_frac=args.rar_frac, batch_sampler=args.batch_sampler,
+            sampler_seed=args.sampler_seed, sampler_state=args.sampler_state,
+            keep_loss=args.keep_loss, check_every=args.check_every,
+            profile=args.profile, profile_start=args.profile_start,
+            profile_steps=args.profile_steps, profile_sync=args.profile_sync,
+            memory_every=args.memory_every
         )
 
     @classmethod
@@ -191,7 +1231,147 @@ class Optimizer:
         p.add_argument(
             '--optimizer', dest='optimizer',
             default=kw.get('optimizer', 'Adam'),
-            choices=['Adam', 'LBFGS'], help='Optimizer to use.'
+            choices=['Adam', 'LBFGS', 'LM'],
+            help='Optimizer to use (LM is Levenberg-Marquardt).'
+        )
+        p.add_argument(
+            '--varpro', dest='varpro', action='store_true',
+            default=kw.get('varpro', False),
+            help='Use variable projection: solve for the output layer '
+            'weights by least squares before every step and only train the '
+            'remaining parameters.  This is exact for linear problems.'
+        )
+        p.add_argument(
+            '--adapt-every', dest='adapt_every',
+            default=kw.get('adapt_every', 0), type=int,
+            help='Adapt the nodes every so many iterations (0 disables). '
+            'Nodes are inserted where the residue is largest and nodes '
+            'that contribute negligibly to the solution are removed.'
+        )
+        p.add_argument(
+            '--adapt-frac', dest='adapt_frac',
+            default=kw.get('adapt_frac', 0.1), type=float,
+            help='Fraction of the number of nodes to insert when adapting.'
+        )
+        p.add_argument(
+            '--adapt-tol', dest='adapt_tol',
+            default=kw.get('adapt_tol', 1e-3), type=float,
+            help='Remove nodes whose removal changes the solution by less '
+            'than this fraction of its root mean square value when adapting.'
+        )
+        p.add_argument(
+            '--max-nodes', dest='max_nodes',
+            default=kw.get('max_nodes', 0), type=int,
+            help='Maximum number of nodes when adapting (0 for no limit).'
+        )
+        p.add_argument(
+            '--reuse-optimizer', dest='reuse_optimizer', action='store_true',
+            default=kw.get('reuse_optimizer', False),
+            help='Keep the optimizer and its state between calls to solve '
+            '(for example across the time steps of the FD schemes).'
+        )
+        p.add_argument(
+            '--linear-step', dest='linear_step', action='store_true',
+            default=kw.get('linear_step', False),
+            help='Only solve for the output layer weights with a single '
+            'least squares step, reusing the factored Hessian while the time '
+            'step is unchanged.  Only for linear problems.'
+        )
+        p.add_argument(
+            '--sampling', dest='sampling',
+            default=kw.get('sampling', 'uniform'),
+            choices=['uniform', 'rad', 'rar'],
+            help='How the interior samples are drawn from the candidates: '
+            'uniformly, residual based adaptive distribution (rad) or '
+            'residual based adaptive refinement (rar) of an active set.'
+        )
+        p.add_argument(
+            '--resample-every', dest='resample_every',
+            default=kw.get('resample_every', 100), type=int,
+            help='Score the candidate samples by their residue every so '
+            'many iterations.'
+        )
+        p.add_argument(
+            '--resample-power', dest='resample_power',
+            default=kw.get('resample_power', 1.0), type=float,
+            help='Exponent of the residue in the rad sampling density.'
+        )
+        p.add_argument(
+            '--resample-floor', dest='resample_floor',
+            default=kw.get('resample_floor', 1.0), type=float,
+            help='Uniform part of the rad sampling density relative to the '
+            'mean of the residue term.'
+        )
+        p.add_argument(
+            '--reweight', dest='reweight', action='store_true',
+            default=kw.get('reweight', False),
+            help='Weight the rad samples by their inverse probability so the '
+            'interior loss is unbiased.'
+        )
+        p.add_argument(
+            '--rar-frac', dest='rar_frac',
+            default=kw.get('rar_frac', 0.1), type=float,
+            help='Fraction of the active samples added by each rar step.'
+        )
+        p.add_argument(
+            '--batch-sampler', dest='batch_sampler',
+            default=kw.get('batch_sampler', 'epoch'),
+            choices=['epoch', 'sobol'],
+            help='How uniform batches of interior samples are drawn: '
+            'shuffled epochs or a scrambled Sobol sequence.'
+        )
+        p.add_argument(
+            '--sampler-seed', dest='sampler_seed',
+            default=kw.get('sampler_seed', None), type=int,
+            help='Seed of the batch sampler (random if not given).'
+        )
+        p.add_argument(
+            '--sampler-state', dest='sampler_state',
+            default=kw.get('sampler_state', None),
+            help='Restore the batch sampler from this sampler.pt file.'
+        )
+        p.add_argument(
+            '--keep-loss', dest='keep_loss',
+            default=kw.get('keep_loss', 0), type=int,
+            help='Only keep the last so many loss values (0 keeps all).'
+        )
+        p.add_argument(
+            '--check-every', dest='check_every',
+            default=kw.get('check_every', None), type=int,
+            help='Check the loss against the tolerance every so many '
+            'iterations (defaults to --n-skip).  Larger values avoid waiting '
+            'for the device every iteration but may train a few iterations '
+            'past the tolerance.'
+        )
+        p.add_argument(
+            '--profile', dest='profile', action='store_true',
+            default=kw.get('profile', False),
+            help='Print and save (profile.npz) the time spent in each phase '
+            'of the iterations and write a torch profiler chrome trace '
+            '(trace.json) of a few iterations to the output directory.'
+        )
+        p.add_argument(
+            '--profile-start', dest='profile_start',
+            default=kw.get('profile_start', 5), type=int,
+            help='First iteration traced with --profile.'
+        )
+        p.add_argument(
+            '--profile-steps', dest='profile_steps',
+            default=kw.get('profile_steps', 5), type=int,
+            help='Number of iterations traced with --profile.'
+        )
+        p.add_argument(
+            '--profile-sync', dest='profile_sync', action='store_true',
+            default=kw.get('profile_sync', False),
+            help='Synchronize the GPU when timing the phases of the '
+            'iterations so the times are those of the device.'
+        )
+        p.add_argument(
+            '--memory-every', dest='memory_every',
+            default=kw.get('memory_every', 0), type=int,
+            help='Record the peak memory and the size of the autograd graph '
+            'of the loss every so many iterations (0 disables).  Saved to '
+            'memory.npz.'
         )
         p.add_argument(
             '-d', '--directory', dest='directory',
@@ -200,7 +1380,15 @@ class Optimizer:
         )
 
     def __init__(self, pde, nn, plotter, n_train, n_skip=100, tol=1e-6, 
-                 lr=1e-2, plot=True, out_dir=None, opt_class=optim.Adam):
+                 lr=1e-2, plot=True, out_dir=None, opt_class=optim.Adam,
+                 varpro=False, adapt_every=0, adapt_frac=0.1,
+                 adapt_tol=1e-3, max_nodes=0, reuse_optimizer=False,
+                 linear_step=False, sampling='uniform', resample_every=100,
+                 resample_power=1.0, resample_floor=1.0, reweight=False,
+                 rar_frac=0.1, batch_sampler='epoch', sampler_seed=None,
+                 sampler_state=None, keep_loss=0, check_every=None,
+                 profile=False, profile_start=5, profile_steps=5,
+                 profile_sync=False, memory_every=0):
         '''Initializer
 
         Parameters
@@ -215,6 +1403,29 @@ class Optimizer:
         plot: bool: Plot live solution.
         out_dir: str: Output directory.
         opt_class: Optimizer to use.
+        varpro: bool: Solve for the output layer weights by least squares.
+        adapt_every: int: Adapt the nodes every so many iterations.
+        adapt_frac: float: Fraction of nodes to insert when adapting.
+        adapt_tol: float: Relative change below which nodes are removed.
+        max_nodes: int: Maximum number of nodes when adapting.
+        reuse_optimizer: bool: Keep the optimizer state between solves.
+        linear_step: bool: Solve for the output weights with one linear step.
+        sampling: str: One of 'uniform', 'rad' or 'rar' (see PDE.resample).
+        resample_every: int: Score the candidate samples this often.
+        resample_power: float: Exponent of the residue for 'rad'.
+        resample_floor: float: Uniform part of the density for 'rad'.
+        reweight: bool: Use importance weights for 'rad'.
+        rar_frac: float: Fraction of active samples added for 'rar'.
+        batch_sampler: str: 'epoch' or 'sobol' batches (see BatchSampler).
+        sampler_seed: int: Seed of the batch sampler.
+        sampler_state: str: File to restore the batch sampler from.
+        keep_loss: int: Only keep the last so many loss values if positive.
+        check_every: int: Check the tolerance this often (default n_skip).
+        profile: bool: Report the phase times and trace some iterations.
+        profile_start: int: First iteration to trace.
+        profile_steps: int: Number of iterations to trace.
+        profile_sync: bool: Synchronize the device when timing the phases.
+        memory_every: int: Record the memory used every so many iterations.
         '''
 
         self.pde = pde
@@ -225,7 +1436,19 @@ class Optimizer:
         self.errors_L1 = []
         self.errors_L2 = []
         self.errors_Linf = []
-        self.loss = []
+        self.loss = MetricRecorder(n_skip, keep_loss)
+        if check_every is None:
+            check_every = n_skip
+        self.check_every = max(check_every, 1)
+        self.timer = PhaseTimer(sync=profile_sync)
+        self.profile = profile
+        self.profile_start = max(profile_start, 1)
+        self.profile_steps = max(profile_steps, 1)
+        self._traced = False
+        self.memory = MemoryRecorder()
+        self.memory_every = memory_every
+        self._iteration = 0
+        self._record_memory = False
         self.time_taken = 0.0
         self.n_train = n_train
         self.n_skip = n_skip
@@ -233,38 +1456,311 @@ class Optimizer:
         self.lr = lr
         self.plot = plot
         self.out_dir = out_dir
+        self.varpro = varpro
+        self.adapt_every = adapt_every
+        self.adapt_frac = adapt_frac
+        self.adapt_tol = adapt_tol
+        self.max_nodes = max_nodes
+        self.node_iterations = 0
+        self.reuse_optimizer = reuse_optimizer
+        self.linear_step = linear_step
+        self.sampling = sampling
+        self.resample_every = resample_every
+        self.resample_power = resample_power
+        self.resample_floor = resample_floor
+        self.reweight = reweight
+        self.rar_frac = rar_frac
+        pde.batch_sampler = batch_sampler
+        pde.sampler_seed = sampler_seed
+        if sampler_state is not None:
+            pde.sampler = BatchSampler(1, 1, device=device())
+            pde.sampler.load_state_dict(
+                torch.load(sampler_state, weights_only=True)
+            )
+        self.opt = None
+        # Eigen decomposition of the Hessian for linear_step keyed by the
+        # time step of the problem, valid for the batch of samples drawn.
+        self._factors = {}
+        self._factors_batch = None
+
+    def _linear_parameters(self):
+        linear_parameters = getattr(self.nn, 'linear_parameters', None)
+        if linear_parameters is None:
+            raise ValueError(
+                f'{type(self.nn).__name__} does not support --varpro or '
+                '--linear-step.'
+            )
+        return list(linear_parameters())
+
+    def solve_linear(self):
+        '''Set the output layer weights to the minimizer of the loss for
+        the current values of the other parameters.
+
+        The residuals are linear in these weights for linear problems, so
+        the least squares problem for the collocation system is solved
+        directly with the Jacobian of the residuals, without forming the
+        normal equations.  The solve is done in double precision with
+        singular values below the precision of the residuals discarded.  For
+        nonlinear problems this is a Gauss-Newton step for the weights.
+        '''
+        params = self._linear_parameters()
+        r = self.pde.residuals(self.nn)
+        self._check_memory(r)
+        J = jacobian(r, params)
+        rcond = torch.finfo(r.dtype).eps
+        dw = torch.linalg.lstsq(
+            J.double().cpu(), -r.detach().double().cpu().unsqueeze(1),
+            rcond=rcond, driver='gelsd'
+        ).solution
+        add_to_parameters(params, dw.squeeze(1))
+
+    def adapt(self):
+        '''Remove nodes whose removal changes the solution little and insert
+        nodes at the interior points with the largest residue.  The
+        parameters and the optimizer state are resized in place.
+        '''
+        pde, nn, opt = self.pde, self.nn, self.opt
+        pts, res = pde.candidate_residue(nn)
+        with torch.no_grad():
+            u = nn(*pts.T).reshape(len(pts), -1)
+        scale = u.pow(2).sum(dim=1).mean().sqrt()
+        if scale > 0:
+            change = nn.removal_change(*pts.T)
+            nn.remove_nodes(change >= self.adapt_tol*scale, optimizer=opt)
+
+        centers = nn.centers()
+        if torch.is_tensor(centers):
+            centers = (centers,)
+        nodes = torch.stack([c.detach() for c in centers], dim=1)
+        h = nn.widths().detach().expand(len(nodes))
+        n_new = max(1, int(self.adapt_frac*len(nodes)))
+        if self.max_nodes > 0:
+            n_new = min(n_new, self.max_nodes - len(nodes))
+        if n_new <= 0:
+            return
+        # Take the candidates with the largest residue that are further than
+        # half a width from the nearest node, counting the ones taken.
+        cand = pts[torch.argsort(res, descending=True)[:10*n_new]]
+        d = torch.cdist(cand, nodes)
+        dmin, nearest = torch.min(d, dim=1)
+        hmin = h[nearest]
+        dc = torch.cdist(cand, cand)
+        selected = []
+        for i in range(len(cand)):
+            if len(selected) >= n_new:
+                break
+            if dmin[i] > 0.5*hmin[i]:
+                selected.append(i)
+                closer = dc[i] < dmin
+                dmin = torch.where(closer, dc[i], dmin)
+                hmin = torch.where(closer, hmin[i], hmin)
+        if selected:
+            nn.insert_nodes(*cand[selected].T, optimizer=opt)
+
+    def step_linear(self):
+        '''Set the output layer weights to the minimizer of the loss
+        assuming it is quadratic in them with a Hessian that only changes
+        with the (effective) time step, so it is factored once and each step
+        only needs the gradient.  The Hessian is factored again whenever the
+        interior samples are resampled.  Returns the loss after the step.
+        '''
+        with self.pde.same_batch():
+            return self._step_linear()
+
+    def _step_linear(self):
+        params = self._linear_parameters()
+        key = getattr(self.pde, 'dt_eff', getattr(self.pde, 'dt', None))
+        loss = self.pde.loss(self.nn)
+        self._check_memory(loss)
+        if self.pde.batch_count != self._factors_batch:
+            self._factors = {}
+            self._factors_batch = self.pde.batch_count
+        if key not in self._factors:
+            g, H = gradient_hessian(loss, params)
+            s, V = torch.linalg.eigh(H.double())
+            smax = s.abs().max()
+            cutoff = torch.finfo(g.dtype).eps*smax
+            sinv = torch.where(s.abs() > cutoff, 1.0/s, torch.zeros_like(s))
+            self._factors[key] = (V, sinv)
+        else:
+            g = torch.cat([
+                x.flatten() for x in ag.grad(loss, params)
+            ])
+        V, sinv = self._factors[key]
+        g = g.double()
+        add_to_parameters(params, -V @ (sinv*(V.T @ g)))
+        return self.pde.loss(self.nn).detach()
+
+    def _check_memory(self, loss):
+        '''Record the memory at the first loss of an iteration that is due
+        to be recorded.
+        '''
+        if self._record_memory:
+            self._record_memory = False
+            with self.timer('memory'):
+                self.memory.record(self._iteration, loss)
+
+    def residual_closure(self):
+        '''Return the residuals of the loss for least squares optimizers.
+        '''
+        r = self.pde.residuals(self.nn)
+        self._check_memory(r)
+        return r
+
+    def _step(self, opt):
+        if isinstance(opt, LevenbergMarquardt):
+            # The trial steps are compared on the batch of the Jacobian.
+            with self.pde.same_batch():
+                loss = opt.step(self.residual_closure)
+            self.loss.append(loss)
+            return loss
+        return opt.step(self.closure).detach()
 
     def closure(self):
         opt = self.opt
         opt.zero_grad()
         loss = self.pde.loss(self.nn)
-        loss.backward(retain_graph=True)
-        self.loss.append(loss.item())
+        self._check_memory(loss)
+        with self.timer('backward'):
+            loss.backward(retain_graph=True)
+        self.loss.append(loss)
         return loss
 
+    def _make_profiler(self):
+        '''Return a torch profiler that traces the iterations from
+        profile_start on, or None if not profiling.
+        '''
+        if not self.profile or self._traced:
+            return None
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device().type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        warmup = min(self.profile_start - 1, 1)
+        schedule = torch.profiler.schedule(
+            wait=self.profile_start - 1 - warmup, warmup=warmup,
+            active=self.profile_steps, repeat=1
+        )
+        fname = os.path.join(self.out_dir or '.', 'trace.json')
+
+        def _export(prof):
+            if self.out_dir is not None and not os.path.exists(self.out_dir):
+                os.makedirs(self.out_dir)
+            prof.export_chrome_trace(fname)
+            print("Saved profiler trace to", fname)
+            self._traced = True
+
+        return torch.profiler.profile(
+            activities=activities, schedule=schedule, on_trace_ready=_export
+        )
+
     def solve(self):
+        '''Train the network, timing the phases of each iteration.'''
+        timer = self.timer
+        pde, nn = self.pde, self.nn
+        timer.wrap(pde, 'interior', 'sample')
+        timer.wrap(nn, 'forward', 'forward')
+        timer.wrap(pde, '_eval_derivatives', 'derivatives')
+        timer.wrap(pde, '_compute_derivatives', 'derivatives')
+        if getattr(nn, 'closed_form', False):
+            timer.wrap(nn, 'derivatives', 'derivatives')
+        timer.wrap(pde, 'loss', 'loss')
+        prof = self._make_profiler()
+        timer.trace = prof is not None
+        try:
+            if prof is not None:
+                prof.start()
+            with timer('other'):
+                self._solve(prof)
+        finally:
+            if prof is not None:
+                prof.stop()
+            timer.trace = False
+            timer.unwrap()
+
+    def _solve(self, prof):
         plotter = self.plotter
         n_train = self.n_train
         n_skip = self.n_skip
-        opt = self.opt_class(self.nn.parameters(), lr=self.lr)
-        self.opt = opt
+        params = list(self.nn.parameters())
+        if self.adapt_every > 0 and not hasattr(self.nn, 'removal_change'):
+            raise ValueError(
+                f'{type(self.nn).__name__} does not support --adapt-every.'
+            )
+        if self.varpro:
+            linear = set(self._linear_parameters())
+            params = [p for p in params if p not in linear]
+        if not params:
+            # Only the output weights are trained, by solve_linear.
+            self.opt = None
+        elif self.opt is None or not self.reuse_optimizer:
+            with self.timer('setup'):
+                self.opt = self.opt_class(params, lr=self.lr)
+        opt = self.opt
         if self.plot:
-            plotter.plot()
+            with self.timer('errors'):
+                plotter.plot()
+        if self.linear_step:
+            n_train = 1
 
         iterations_done = False
+        below = torch.zeros((), dtype=torch.bool, device=device())
+        timer = self.timer
         start = time.perf_counter()
         for i in range(1, n_train+1):
-            loss = opt.step(self.closure)
-            if loss.item() < self.tol:
+            timer.iterations += 1
+            self._iteration += 1
+            self._record_memory = (
+                self.memory_every > 0 and
+                self._iteration % self.memory_every == 0
+            )
+            if self.linear_step:
+                with timer('step'):
+                    loss = self.step_linear()
+                self.loss.append(loss)
                 iterations_done = True
+            else:
+                with timer('step'):
+                    if self.varpro:
+                        # Solve for the output weights and step the other
+                        # parameters on the same batch.
+                        with self.pde.same_batch():
+                            self.solve_linear()
+                            if opt is None:
+                                loss = self.pde.loss(self.nn).detach()
+                                self.loss.append(loss)
+                            else:
+                                loss = self._step(opt)
+                    else:
+                        loss = self._step(opt)
+            if self.adapt_every > 0:
+                self.node_iterations += self.nn.weights().shape[1]
+                if i % self.adapt_every == 0 and i < n_train:
+                    with timer('adapt'):
+                        self.adapt()
+            if (self.sampling != 'uniform' and self.resample_every > 0 and
+                    i % self.resample_every == 0 and i < n_train):
+                with timer('adapt'):
+                    self.pde.resample(
+                        self.nn, self.sampling, self.resample_power,
+                        self.resample_floor, self.reweight, self.rar_frac
+                    )
+            # The tolerance test is accumulated on the device and only
+            # read every check_every iterations, the losses are only copied
+            # to the host when printing.
+            if self.tol > 0:
+                below |= loss < self.tol
+                if i % self.check_every == 0 and below.item():
+                    iterations_done = True
             if i % n_skip == 0 or i == n_train or iterations_done:
+                self.loss.flush()
                 err_L1 = 0.0
                 err_L2 = 0.0
                 err_Linf = 0.0
-                if self.plot:
-                    err_L1, err_L2, err_Linf = plotter.plot()
-                else:
-                    err_L1, err_L2, err_Linf = plotter.get_error()
+                with timer('errors'):
+                    if self.plot:
+                        err_L1, err_L2, err_Linf = plotter.plot()
+                    else:
+                        err_L1, err_L2, err_Linf = plotter.get_error()
                 self.errors_L1.append(err_L1)
                 self.errors_L2.append(err_L2)
                 self.errors_Linf.append(err_Linf)
@@ -276,14 +1772,38 @@ class Optimizer:
                     f"Iteration ({i}/{n_train}): Loss={loss.item():.3e}" +
                     e_str
                 )
+            if prof is not None:
+                with timer('profiler'):
+                    prof.step()
             if iterations_done:
                 break
         time_taken = time.perf_counter() - start
         self.time_taken = time_taken
         print(f"Done. Took {time_taken:.3f} seconds.")
+        if self.adapt_every > 0:
+            print(
+                f"Final number of nodes: {self.nn.weights().shape[1]}, "
+                f"node-iterations: {self.node_iterations}"
+            )
         if self.plot:
             plotter.show()
 
+    def print_summary(self):
+        '''Print the time spent in each phase of the iterations (with
+        `profile`) and the memory used (if recorded).
+        '''
+        if self.profile:
+            print(self.timer.summary())
+        if len(self.memory) > 0:
+            print(self.memory.summary())
+
+    def save_summary(self, dirname):
+        '''Save the summaries printed by `print_summary` to `dirname`.'''
+        if self.profile:
+            self.timer.save(os.path.join(dirname, 'profile.npz'))
+        if len(self.memory) > 0:
+            self.memory.save(os.path.join(dirname, 'memory.npz'))
+
     def save(self):
         dirname = self.out_dir
         if self.out_dir is None:
@@ -298,6 +1818,12 @@ class Optimizer:
             error_L2=self.errors_L2, error_Linf=self.errors_Linf,
             time_taken=self.time_taken
         )
+        self.save_summary(dirname)
+        if self.pde.sampler is not None:
+            torch.save(
+                self.pde.sampler.state_dict(),
+                os.path.join(dirname, 'sampler.pt')
+            )
         self.plotter.save(dirname)
 
 
@@ -330,6 +1856,14 @@ class App:
             default=kw.get('gpu', False),
             help='Run code on the GPU.'
         )
+        p.add_argument(
+            '--diff-backend', dest='diff_backend',
+            default=kw.get('diff_backend', 'autograd'),
+            choices=['autograd', 'func'],
+            help='Backend used to compute derivatives of the solution. '
+            '"func" does not need the points to require gradients but is '
+            'about 1.5x slower than "autograd".'
+        )
         classes = (
             self.pde_cls, self.nn_cls, self.plotter_cls, self.optimizer
         )
@@ -351,6 +1885,7 @@ class App:
         activation = self._get_activation(args)
 
         pde = self.pde_cls.from_args(args)
+        pde.diff_backend = args.diff_backend
         self.pde = pde
         dev = device()
         nn = self.nn_cls.from_args(pde, activation, args).to(dev)
@@ -362,5 +1897,6 @@ class App:
         self.solver = solver
 
         solver.solve()
+        solver.print_summary()
         if args.directory is not None:
             solver.save()
@@ -1,19 +1,61 @@
 # Base class for hybrid finite difference SPINN models
 
+import copy
 import os
 import numpy as np
 import matplotlib.pyplot as plt
 import torch
 
-from common import device
+from torch.func import functional_call, jacfwd
+
+from common import (
+    SnapshotWriter, TimeSeriesStore, add_to_parameters, device
+)
 from spinn1d import App1D, Plotter1D
 from ode_base import BasicODE
 
 
 class FDPlotter1D(Plotter1D):
+    @classmethod
+    def from_args(cls, pde, nn, args):
+        return cls(pde, nn, args.no_show_exact, eval_chunk=args.eval_chunk,
+                   async_save=args.async_save, series=args.series)
+
+    @classmethod
+    def setup_argparse(cls, parser, **kw):
+        super().setup_argparse(parser, **kw)
+        parser.add_argument(
+            '--async-save', dest='async_save', action='store_true',
+            default=kw.get('async_save', False),
+            help='Write the output files on a background thread.'
+        )
+        parser.add_argument(
+            '--series', dest='series', action='store_true',
+            default=kw.get('series', False),
+            help='Append the output to a single memory mapped time series '
+            'store instead of writing files for every output step.'
+        )
+
+    def __init__(self, pde, nn, no_show_exact=False, eval_chunk=4096,
+                 async_save=False, series=False):
+        super().__init__(pde, nn, no_show_exact, eval_chunk)
+        self.writer = SnapshotWriter() if async_save else None
+        self.series = series
+        self.store = None
+
+    def open_store(self, dirname, capacity):
+        self.store = TimeSeriesStore(dirname, capacity)
+
     def show(self):
         pass
 
+    def close(self):
+        '''Wait for any pending output to be written.'''
+        if self.writer is not None:
+            self.writer.close()
+        if self.store is not None:
+            self.store.close()
+
     def plot_solution(self):
         xn, pn = self.get_plot_data()
         pde = self.pde
@@ -49,12 +91,51 @@ class FDPlotter1D(Plotter1D):
         '''
         iter = self.pde.iter
         t = self.pde.t
-        modelfname = os.path.join(dirname, 'model_%04d.pt' % iter)
-        torch.save(self.nn.state_dict(), modelfname)
-        rfile = os.path.join(dirname, 'results_%04d.npz' % iter)
+        state = {
+            k: v.detach().cpu().clone()
+            for k, v in self.nn.state_dict().items()
+        }
         x, y = self.get_plot_data()
         y_exact = self.pde.exact(x)
-        np.savez(rfile, x=x, y=y, y_exact=y_exact, t=t, iter=iter)
+        if self.store is not None:
+            func = self.store.append
+            args = (t, iter)
+            kw = dict(x=x, y=y, y_exact=y_exact)
+            kw.update((k, v.numpy()) for k, v in state.items())
+        else:
+            func = self._write
+            modelfname = os.path.join(dirname, 'model_%04d.pt' % iter)
+            rfile = os.path.join(dirname, 'results_%04d.npz' % iter)
+            data = dict(x=x, y=y, y_exact=y_exact, t=t, iter=iter)
+            args = (modelfname, state, rfile, data)
+            kw = {}
+        if self.writer is None:
+            func(*args, **kw)
+        else:
+            self.writer.submit(func, *args, **kw)
+
+    def _write(self, modelfname, state, rfile, data):
+        torch.save(state, modelfname)
+        np.savez(rfile, **data)
+
+
+# Diagonal coefficient and lower triangular Butcher tableau of the singly
+# diagonally implicit Runge-Kutta schemes.  Both are stiffly accurate so the
+# last stage is the solution at the end of the step.
+_g2 = 1.0 - np.sqrt(0.5)
+_g3 = 0.4358665215084590
+SDIRK = {
+    'SDIRK2': (_g2, [[], [1.0 - _g2]]),
+    'SDIRK3': (_g3, [
+        [],
+        [(1.0 - _g3)/2],
+        [-(6*_g3**2 - 16*_g3 + 1)/4, (6*_g3**2 - 20*_g3 + 5)/4]
+    ])
+}
+
+
+# Order of accuracy of the schemes used to estimate the local error.
+ORDER = {'BE': 1, 'CN': 2, 'BDF2': 2, 'SDIRK2': 2, 'SDIRK3': 3}
 
 
 class FDSPINN1D(BasicODE):
@@ -64,7 +145,12 @@ class FDSPINN1D(BasicODE):
     @classmethod
     def from_args(cls, args):
         return cls(args.nodes, args.samples, args.sample_frac,
-                   args.dt, args.T, args.t_skip)
+                   args.dt, args.T, args.t_skip, scheme=args.scheme,
+                   adaptive=args.adaptive, dt_min=args.dt_min,
+                   dt_max=args.dt_max, dt_tol=args.dt_tol,
+                   evolve=args.evolve, evolve_rcond=args.evolve_rcond,
+                   evolve_damping=args.evolve_damping,
+                   evolve_nodes=args.evolve_nodes)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -86,41 +172,172 @@ class FDSPINN1D(BasicODE):
             default=kw.get('t_skip', 10), type=int,
             help='Iterations'
         )
+        p.add_argument(
+            '--scheme', dest='scheme',
+            default=kw.get('scheme', 'BE'),
+            choices=['BE', 'CN', 'BDF2', 'SDIRK2', 'SDIRK3'],
+            help='Implicit time integration scheme.'
+        )
+        p.add_argument(
+            '--adaptive', dest='adaptive', action='store_true',
+            default=kw.get('adaptive', False),
+            help='Adapt the time step using step doubling.  Output is still '
+            'written every t_skip*dt of the initial time step.'
+        )
+        p.add_argument(
+            '--dt-min', dest='dt_min',
+            default=kw.get('dt_min', 1e-5), type=float,
+            help='Minimum time step when adapting.'
+        )
+        p.add_argument(
+            '--dt-max', dest='dt_max',
+            default=kw.get('dt_max', 0.1), type=float,
+            help='Maximum time step when adapting.'
+        )
+        p.add_argument(
+            '--dt-tol', dest='dt_tol',
+            default=kw.get('dt_tol', 1e-3), type=float,
+            help='Tolerance for the local error estimate when adapting.'
+        )
+        p.add_argument(
+            '--evolve', dest='evolve',
+            default=kw.get('evolve', None), choices=['euler', 'rk4'],
+            help='Evolve the network parameters in time with this explicit '
+            'integrator instead of optimizing the network every step.'
+        )
+        p.add_argument(
+            '--evolve-rcond', dest='evolve_rcond',
+            default=kw.get('evolve_rcond', 1e-4), type=float,
+            help='Relative cutoff for the singular values of the Jacobian '
+            'when solving for the parameter velocities.'
+        )
+        p.add_argument(
+            '--evolve-damping', dest='evolve_damping',
+            default=kw.get('evolve_damping', 1e-2), type=float,
+            help='Tikhonov damping of the parameter velocities relative to '
+            'the largest singular value of the Jacobian.  This keeps the '
+            'explicit integrators stable for diffusion.'
+        )
+        p.add_argument(
+            '--evolve-nodes', dest='evolve_nodes', action='store_true',
+            default=kw.get('evolve_nodes', False),
+            help='Also evolve the centers and widths of the nodes, by '
+            'default only the output weights are evolved.'
+        )
 
-    def __init__(self, n, ns, sample_frac=1.0, dt=1e-3, T=1.0, t_skip=10):
+    def __init__(self, n, ns, sample_frac=1.0, dt=1e-3, T=1.0, t_skip=10,
+                 scheme='BE', adaptive=False, dt_min=1e-5, dt_max=0.1,
+                 dt_tol=1e-3, evolve=None, evolve_rcond=1e-4,
+                 evolve_damping=1e-2, evolve_nodes=False):
         super().__init__(n, ns, sample_frac)
+        if adaptive and scheme == 'BDF2':
+            raise ValueError('BDF2 needs a constant time step.')
+        if adaptive and evolve:
+            raise ValueError('Adaptive steps are not supported with evolve.')
+        self.evolve = evolve
+        self.evolve_rcond = evolve_rcond
+        self.evolve_damping = evolve_damping
+        self.evolve_nodes = evolve_nodes
+        self.adaptive = adaptive
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.dt_tol = dt_tol
         self.iter = 0
         self.dt = dt
         self.t = 0.0
         self.T = T
         self.t_skip = t_skip
+        self.scheme = scheme
         self.u0 = self.initial(self.xs)
+        # History at the sample points: the previous solution (for BDF2),
+        # the rhs of the current solution and of the stages of a step.
+        self.u_prev = None
+        self.f0 = None
+        self.f_stages = []
+        # Each stage solves u - c - dt_eff*rhs(u) = 0.
+        self.c = self.u0
+        self.dt_eff = dt
 
-    def pde(self, x, u, ux, uxx, u0, dt):
-        pass
+    def rhs(self, x, u, ux, uxx):
+        '''Return the spatial operator f of the equation u_t = f.'''
+        raise NotImplementedError()
 
-    def sample_arrays(self, *args):
-        if abs(self.sample_frac - 1.0) < 1e-3:
-            return args
+    def _rhs_of(self, u, xs):
+        u, ux, uxx = self._compute_derivatives(u, xs)
+        return self.rhs(xs, u, ux, uxx).detach()
+
+    def n_stages(self):
+        return len(SDIRK[self.scheme][1]) if self.scheme in SDIRK else 1
+
+    def set_stage(self, stage):
+        '''Setup the explicit part and the effective time step of the given
+        stage of the current step.
+        '''
+        dt, u0, scheme = self.dt, self.u0, self.scheme
+        if scheme in ('CN',) + tuple(SDIRK) and self.f0 is None:
+            self.f0 = self._rhs_of(self.initial(self.xs), self.xs)
+        if scheme == 'CN':
+            self.c, self.dt_eff = u0 + 0.5*dt*self.f0, 0.5*dt
+        elif scheme == 'BDF2' and self.u_prev is not None:
+            self.c, self.dt_eff = (4*u0 - self.u_prev)/3, 2*dt/3
+        elif scheme in SDIRK:
+            gamma, a = SDIRK[scheme]
+            if stage == 0:
+                self.f_stages = []
+            c = u0
+            for aij, fj in zip(a[stage], self.f_stages):
+                c = c + dt*aij*fj
+            self.c, self.dt_eff = c, gamma*dt
         else:
-            idx = np.random.choice(
-                self.rng_interior,
-                size=self.sample_size, replace=False
-            )
-            return (arr[idx] for arr in args)
+            self.c, self.dt_eff = u0, dt
+
+    def end_stage(self, nn):
+        if self.scheme in SDIRK:
+            self.f_stages.append(self._rhs_of(nn(self.xs), self.xs))
+
+    def end_step(self, nn):
+        '''Update the history once the step has been solved.'''
+        self.t += self.dt
+        self.iter += 1
+        self.u_prev = self.u0
+        u = nn(self.xs)
+        if self.scheme in ('CN',) + tuple(SDIRK):
+            self.f0 = self._rhs_of(u, self.xs)
+        self.u0 = u.detach()
+
+    def get_state(self):
+        '''Return the time and history so a step can be undone.'''
+        keys = ('t', 'iter', 'u0', 'u_prev', 'f0', 'f_stages')
+        return {k: getattr(self, k) for k in keys}
+
+    def set_state(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
 
     def interior(self):
         return self.xs
 
+    def _residue(self, nn, xs, c):
+        u, ux, uxx = self._eval_derivatives(nn, xs)
+        return u - c - self.dt_eff*self.rhs(xs, u, ux, uxx)
+
+    def _get_residue(self, nn):
+        return self._residue(nn, self.interior(), self.c)
+
     def interior_loss(self, nn):
-        xs, u0 = self.sample_arrays(self.interior(), self.u0)
-        u = nn(xs)
-        u, ux, uxx = self._compute_derivatives(u, xs)
-        res = self.pde(xs, u, ux, uxx, u0, self.dt)
-        return (res**2).mean()
+        xs, c = self.sample_arrays(self.interior(), self.c)
+        res = self._residue(nn, xs, c)
+        return self.sample_weighted(res**2).mean()
+
+    def interior_residuals(self, nn):
+        xs, c = self.sample_arrays(self.interior(), self.c)
+        return self.sample_root_weighted(self._residue(nn, xs, c))
 
 
 class AppFD1D(App1D):
+    # Sum of the residues left by the solves, see `step`.
+    train_error = None
+
     def run(self, args=None, **kw):
         parser = self.setup_argparse(**kw)
         args = parser.parse_args(args)
@@ -133,6 +350,7 @@ class AppFD1D(App1D):
         activation = self._get_activation(args)
 
         pde = self.pde_cls.from_args(args)
+        pde.diff_backend = args.diff_backend
         self.pde = pde
         dev = device()
         nn = self.nn_cls.from_args(pde, activation, args).to(dev)
@@ -144,6 +362,165 @@ class AppFD1D(App1D):
         self.solver = solver
         self.iterate()
 
+    def step(self):
+        '''Advance the solution by one step of size pde.dt.
+
+        If `train_error` is not None the root mean square residue left by
+        each solve is added to it.
+        '''
+        pde = self.pde
+        for stage in range(pde.n_stages()):
+            pde.set_stage(stage)
+            self.solver.solve()
+            if self.train_error is not None:
+                res = pde._get_residue(self.nn).detach()
+                self.train_error += res.pow(2).mean().sqrt().item()
+            pde.end_stage(self.nn)
+        pde.end_step(self.nn)
+
+    def _evolved_parameters(self):
+        '''Return the (name, parameter) pairs evolved in time, only the
+        output weights unless `pde.evolve_nodes` is set.
+        '''
+        named = list(self.nn.named_parameters())
+        if self.pde.evolve_nodes:
+            return named
+        linear = set(self.nn.linear_parameters())
+        return [(name, p) for name, p in named if p in linear]
+
+    def parameter_velocity(self):
+        '''Return the time derivative of the flattened evolved parameters of
+        the network as the least squares solution of J dp/dt = f where J is
+        the Jacobian of the network output with respect to them and f the
+        rhs, both at the sample points.  The boundary values are assumed to
+        be constant in time and are kept fixed with weighted rows.
+
+        The velocity is damped by also minimizing (lambda s dp/dt)**2 where
+        s is the largest singular value of the Jacobian and lambda is
+        `evolve_damping`.  Without this the directions with small singular
+        values, which resolve the finest scales, get large velocities and
+        the explicit integrators blow up for diffusion.  Small singular
+        values are also discarded.
+        '''
+        pde, nn = self.pde, self.nn
+        names, params = zip(*self._evolved_parameters())
+
+        def output(p, x):
+            return functional_call(nn, dict(zip(names, p)), (x,))
+
+        def jacobian(x):
+            J = jacfwd(output)(tuple(p.detach() for p in params), x)
+            return torch.cat([j.reshape(len(x), -1) for j in J], dim=1)
+
+        xs = pde.interior()
+        u, ux, uxx = pde._eval_derivatives(nn, xs)
+        f = pde.rhs(xs, u, ux, uxx).detach()
+        xb = pde.boundary()
+        A = torch.cat((jacobian(xs.detach()), 10.0*jacobian(xb)))
+        b = torch.cat((f, torch.zeros(len(xb), device=f.device)))
+        A, b = A.double().cpu(), b.double().cpu()
+        if pde.evolve_damping > 0:
+            n = A.shape[1]
+            s = torch.linalg.matrix_norm(A, ord=2)
+            A = torch.cat((A, pde.evolve_damping*s*torch.eye(n).to(A)))
+            b = torch.cat((b, b.new_zeros(n)))
+        rcond = pde.evolve_rcond
+        dp = torch.linalg.lstsq(
+            A, b.unsqueeze(1), rcond=rcond, driver='gelsd'
+        ).solution
+        return dp.squeeze(1)
+
+    def evolve_step(self):
+        '''Advance the network parameters by one step of size pde.dt.'''
+        pde = self.pde
+        dt = pde.dt
+        params = [p for _, p in self._evolved_parameters()]
+        if pde.evolve == 'euler':
+            add_to_parameters(params, dt*self.parameter_velocity())
+        else:
+            p0 = [p.detach().clone() for p in params]
+
+            def reset():
+                with torch.no_grad():
+                    for p, v in zip(params, p0):
+                        p.copy_(v)
+
+            k1 = self.parameter_velocity()
+            add_to_parameters(params, 0.5*dt*k1)
+            k2 = self.parameter_velocity()
+            reset()
+            add_to_parameters(params, 0.5*dt*k2)
+            k3 = self.parameter_velocity()
+            reset()
+            add_to_parameters(params, dt*k3)
+            k4 = self.parameter_velocity()
+            reset()
+            add_to_parameters(params, dt*(k1 + 2*k2 + 2*k3 + k4)/6)
+        pde.end_step(self.nn)
+
+    def adaptive_step(self, t_end):
+        '''Advance the solution by at most `t_end - pde.t` using step
+        doubling to control the local error.  The time step is halved until
+        the error estimate is within `dt_tol` and doubled when it is well
+        within it.
+
+        Each step is only trained to the optimizer tolerance so the
+        difference of the solutions also contains their training error,
+        estimated by the residues left by the solves.  When this exceeds
+        `dt_tol` the estimate cannot be trusted, so the solves
+        are tightened (a smaller optimizer tolerance and more iterations)
+        and the step retried, and an error is raised if that does not help.
+        '''
+        pde, nn, solver = self.pde, self.nn, self.solver
+        p = ORDER[pde.scheme]
+        h = pde.dt
+        n_rejected = n_tightened = 0
+        while True:
+            dt = min(h, t_end - pde.t)
+            state = pde.get_state()
+            nn_state = copy.deepcopy(nn.state_dict())
+            pde.dt = dt
+            self.train_error = 0.0
+            self.step()
+            u_big = pde.u0
+            pde.set_state(state)
+            nn.load_state_dict(nn_state)
+            pde.dt = dt/2
+            self.step()
+            self.step()
+            err = torch.max(torch.abs(pde.u0 - u_big)).item()/(2**p - 1)
+            noise = self.train_error/(2**p - 1)
+            self.train_error = None
+            if noise > pde.dt_tol:
+                if solver.linear_step or solver.tol <= 0 or n_tightened == 2:
+                    raise RuntimeError(
+                        f"Training error {noise:.3e} exceeds --dt-tol "
+                        f"{pde.dt_tol:.3e}, train the steps further or use "
+                        "a larger --dt-tol."
+                    )
+                solver.tol /= 100
+                solver.n_train *= 2
+                n_tightened += 1
+                print(
+                    "Training error %.3e exceeds dt_tol, training to %.3e "
+                    "for up to %d iterations" %
+                    (noise, solver.tol, solver.n_train)
+                )
+            elif err <= pde.dt_tol or dt/2 < pde.dt_min:
+                break
+            else:
+                h = max(dt/2, pde.dt_min)
+                n_rejected += 1
+            pde.set_state(state)
+            nn.load_state_dict(nn_state)
+        if err <= pde.dt_tol/2**(p + 1):
+            h = min(2*h, pde.dt_max)
+        pde.dt = h
+        print(
+            "Current time: %f, dt: %.3e, error: %.3e, rejected: %d" %
+            (pde.t, dt, err, n_rejected)
+        )
+
     def iterate(self):
         n_itr = round(self.pde.T/self.pde.dt + 0.49)
         out_dir = self.solver.out_dir
@@ -155,16 +532,43 @@ class AppFD1D(App1D):
                 os.makedirs(out_dir)
                 print("Saving output to", out_dir)
 
-        for itr in range(n_itr):
+        if out_dir is not None and getattr(self.plotter, 'series', False):
+            self.plotter.open_store(out_dir, n_itr//self.pde.t_skip + 1)
+
+        try:
+            self._march(n_itr, out_dir)
+        finally:
+            self.plotter.close()
+        self.solver.print_summary()
+        if out_dir is not None:
+            self.solver.save_summary(out_dir)
+        plt.show()
+
+    def _march(self, n_itr, out_dir):
+        pde = self.pde
+        if pde.evolve:
+            print("Fitting the initial condition.")
+            pde.c, pde.dt_eff = pde.u0, 0.0
             self.solver.solve()
-            self.pde.t += self.pde.dt
-            self.pde.iter += 1
+        if pde.adaptive:
+            dt_out = pde.t_skip*pde.dt
+            n_out = round(n_itr/pde.t_skip + 0.49)
+            for i in range(1, n_out + 1):
+                t_out = min(i*dt_out, pde.T)
+                while pde.t < t_out - 1e-10*dt_out:
+                    self.adaptive_step(t_out)
+                pde.t = t_out
+                if out_dir is not None:
+                    self.plotter.save(out_dir)
+            return
+
+        for itr in range(n_itr):
+            if pde.evolve:
+                self.evolve_step()
+            else:
+                self.step()
             print("Current time: %f" % self.pde.t)
-            with torch.no_grad():
-                self.pde.u0 = self.nn(self.pde.xs)
 
             if (itr + 1) % self.pde.t_skip == 0:
                 if out_dir is not None:
                     self.plotter.save(out_dir)
-
-        plt.show()
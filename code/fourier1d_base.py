@@ -57,6 +57,9 @@ class Fourier1D(nn.Module):
         x = self.layer2(x)
         return x.squeeze()
 
+    def linear_parameters(self):
+        return self.layer2.parameters()
+
 
 class FourierPlotter1D(Plotter1D):
     def plot_weights(self):
@@ -32,7 +32,9 @@ class GConvNet(nn.Module):
     @classmethod
     def from_args(cls, pde, activation, args):
         return cls(pde, activation, fixed_h=args.fixed_h,
-                   use_pu=args.pu, max_nbrs=args.max_nbrs)
+                   use_pu=args.pu, max_nbrs=args.max_nbrs,
+                   rebuild_frac=args.rebuild_frac,
+                   rebuild_h=args.rebuild_h)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -50,13 +52,33 @@ class GConvNet(nn.Module):
             default=kw.get('max_nbrs', 49),
             help='Maximum number of neighbors to use.'
         )
+        p.add_argument(
+            '--rebuild-frac', dest='rebuild_frac', type=float,
+            default=kw.get('rebuild_frac', 0.1),
+            help='Rebuild the neighbor graph when a node moves more than '
+            'this fraction of its width.'
+        )
+        p.add_argument(
+            '--rebuild-h', dest='rebuild_h', type=float,
+            default=kw.get('rebuild_h', 0.1),
+            help='Rebuild the neighbor graph when a node width changes by '
+            'more than this fraction.'
+        )
 
     def __init__(self, pde, activation,
-                 fixed_h=False, use_pu=False, max_nbrs=25):
+                 fixed_h=False, use_pu=False, max_nbrs=25,
+                 rebuild_frac=0.1, rebuild_h=0.1):
         super().__init__()
         self.activation = activation
         self.use_pu = use_pu
         self.max_nbrs = max_nbrs
+        self.rebuild_frac = rebuild_frac
+        self.rebuild_h = rebuild_h
+        # Cached neighbor graphs as (targets, nodes, h, edge_index).
+        self._graphs = []
+        self.max_graphs = 4
+        self.n_builds = 0
+        self.n_calls = 0
         points = pde.nodes()
         fixed_points = pde.fixed_nodes()
         n_free = len(points[0])
@@ -90,10 +112,38 @@ class GConvNet(nn.Module):
             self.u = nn.Parameter(tensor(np.zeros(self.n)))
         self.sph = SPHConv(self.activation)
 
+    def _neighbors(self, nodes, target):
+        '''Return the kNN graph for the target points.
+
+        The graph is cached per target point set and only rebuilt when a
+        node has moved by more than `rebuild_frac` of its width or a width
+        has changed by more than `rebuild_h` relative to when it was built.
+        '''
+        self.n_calls += 1
+        nodes, target = nodes.detach(), target.detach()
+        h = torch.abs(self.h.detach())
+        for i, (pts, pos, h0, index) in enumerate(self._graphs):
+            if pts.shape == target.shape and torch.equal(pts, target):
+                moved = torch.linalg.norm(nodes - pos, dim=1)
+                stale = (
+                    (moved > self.rebuild_frac*h0).any() or
+                    (torch.abs(h - h0) > self.rebuild_h*h0).any()
+                )
+                if not stale:
+                    return index
+                del self._graphs[i]
+                break
+
+        index = knn(nodes, target, self.max_nbrs)
+        self.n_builds += 1
+        self._graphs.insert(0, (target.clone(), nodes.clone(), h, index))
+        del self._graphs[self.max_graphs:]
+        return index
+
     def forward(self, x, y):
         target = torch.stack((x, y), dim=1)
         nodes = torch.vstack((self.points, self.f_points))
-        a_index = knn(nodes, target, self.max_nbrs)
+        a_index = self._neighbors(nodes, target)
         h = self.widths()
         if self.use_pu:
             dnr = self.sph.forward(x, y, nodes,
@@ -117,6 +167,9 @@ class GConvNet(nn.Module):
     def weights(self):
         return self.u
 
+    def linear_parameters(self):
+        return [self.u]
+
 
 if __name__ == '__main__':
     app = App2D(
@@ -124,3 +177,5 @@ if __name__ == '__main__':
         plotter_cls=Plotter2D
     )
     app.run(nodes=40, samples=120, lr=1e-2)
+    nn = app.nn
+    print(f"Neighbor graph built {nn.n_builds} times in {nn.n_calls} calls.")
@@ -6,8 +6,8 @@ import numpy as np
 import torch
 
 from common import tensor
-from ibvp2d_base import IBVP2D
-from spinn2d import Plotter2D, SPINN2D, App2D
+from ibvp2d_base import IBVP2D, IBVPApp2D
+from spinn2d import Plotter2D, SPINN2D
 
 
 class HeatPlotter(Plotter2D):
@@ -22,7 +22,7 @@ class HeatPlotter(Plotter2D):
         uex_p = self.pde.exact(xp, yp)
         x, t = np.mgrid[0:1:100j, 0:0.2:21j]
         xt, tt = tensor(x.ravel()), tensor(t.ravel())
-        u = self.nn(xt, tt).detach().cpu().numpy()
+        u = self.evaluator(xt, tt).cpu().numpy()
         u_exact = self.pde.exact(x, t)
         u.shape = x.shape
         np.savez(rfile, x=x, t=t, u=u, u_exact=u_exact,
@@ -44,16 +44,12 @@ class Heat1D(IBVP2D):
         a2 = (np.pi*c/L)**2
         return b1*np.exp(-a2*t)*np.sin(np.pi*x/L)
 
-    def boundary_loss(self, nn):
-        xb, tb = self.boundary()
-        u = nn(xb, tb)
-        ub = self.exact(xb.detach().cpu().numpy(), tb.detach().cpu().numpy())
-        bc = u - tensor(ub)
-        return (bc**2).sum()
+    def boundary_value(self, x, t):
+        return self.exact(x, t)
 
 
 if __name__ == '__main__':
-    app = App2D(
+    app = IBVPApp2D(
         pde_cls=Heat1D,
         nn_cls=SPINN2D,
         plotter_cls=HeatPlotter
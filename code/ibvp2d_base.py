@@ -2,11 +2,15 @@
 # (1 space dimension and 1 time dimension)
 # Common class to implement both parabolic and hyperbolic PDEs
 
+import multiprocessing
+import os
+
 import numpy as np
 from numpy.testing._private.utils import requires_memory
 import torch
-import torch.autograd as ag
-from common import PDE, tensor
+from common import PDE, device, load_resized, tensor
+from samplers import box_points
+from spinn2d import App2D
 
 
 class IBVP2D(PDE):
@@ -15,7 +19,7 @@ class IBVP2D(PDE):
         return cls(args.nodes, args.samples,
                    args.b_nodes, args.b_samples,
                    args.xL, args.xR, args.T,
-                   args.sample_frac)
+                   args.sample_frac, args.sampler)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -60,26 +64,13 @@ class IBVP2D(PDE):
             default=kw.get('sample_frac', 1.0), type=float,
             help='Fraction of interior nodes used for sampling.'
         )
-
-    def _compute_derivatives(self, u, xs, ts):
-        du = ag.grad(
-            outputs=u, inputs=(xs, ts),
-            grad_outputs=torch.ones_like(u),
-            retain_graph=True, create_graph=True
-        )
-        d2ux = ag.grad(
-            outputs=du[0], inputs=(xs, ts),
-            grad_outputs=torch.ones_like(du[0]),
-            retain_graph=True, create_graph=True
-        )
-        d2ut = ag.grad(
-            outputs=du[1], inputs=(xs, ts),
-            grad_outputs=torch.ones_like(du[1]),
-            retain_graph=True, create_graph=True
+        p.add_argument(
+            '--sampler', dest='sampler',
+            default=kw.get('sampler', 'grid'),
+            choices=['grid', 'sobol', 'halton', 'lhs'],
+            help='Point set used for the interior samples.'
         )
 
-        return u, du[0], du[1], d2ux[0],  d2ut[1]
-
     def _get_points_split(self, L, T, n):
         size = np.sqrt(L*T/n)
         nx = round((L/size) + 0.49)
@@ -117,17 +108,35 @@ class IBVP2D(PDE):
         return (xs, ts)
 
     def __init__(self, n_nodes, ns, nb=None, nbs=None, xL=0.0, xR=1.0,
-                 T=1.0, sample_frac=1.0):
+                 T=1.0, sample_frac=1.0, sampler='grid'):
         self.xL = xL
         self.xR = xR
-        self.T  = T
+        self.n_nodes = n_nodes
+        self.ns = ns
+        self.nb = nb
+        self.nbs = nbs
 
         self.sample_frac = sample_frac
+        self.point_set = sampler
+        self.u_initial = None
+        self.set_time_window(0.0, T)
+
+    def set_time_window(self, t0, T):
+        '''Set the problem up over the time interval [t0, t0 + T].
+
+        This clears any initial condition set using `set_initial`.
+        '''
+        self.t0 = t0
+        self.T = T
+        self.u_initial = None
+        xL, xR = self.xL, self.xR
+        n_nodes, ns, nb, nbs = self.n_nodes, self.ns, self.nb, self.nbs
 
         # Interior nodes
         self.nx, self.nt = self._get_points_split((xR - xL), T, n_nodes)
-        self.i_nodes = self._get_points_mgrid(xL, xR, T,
+        x, t = self._get_points_mgrid(xL, xR, T,
             self.nx, self.nt, endpoint=False)
+        self.i_nodes = (x, t + t0)
 
         # Fixed nodes
         if nb is None:
@@ -135,28 +144,68 @@ class IBVP2D(PDE):
         else:
             nbx, nbt = self._get_points_split((xR - xL), T, nb)
 
-        self.f_nodes = self._get_boundary_nodes(xL, xR, T, nbx, nbt)
+        x, t = self._get_boundary_nodes(xL, xR, T, nbx, nbt)
+        self.f_nodes = (x, t + t0)
 
         # Interior samples
         self.nsx, self.nst = self._get_points_split((xR - xL), T, ns)
-        xi, ti = self._get_points_mgrid(xL, xR, T,
-            self.nsx, self.nst, endpoint=False)
+        if self.point_set == 'grid':
+            xi, ti = self._get_points_mgrid(xL, xR, T,
+                self.nsx, self.nst, endpoint=False)
+        else:
+            xi, ti = box_points(self.nsx*self.nst, (xL, 0.0), (xR, T),
+                                self.point_set)
+        ti = ti + t0
         self.p_samples = (tensor(xi, requires_grad=True),
                           tensor(ti, requires_grad=True))
+        if self.point_set == 'grid':
+            grid_shape = (self.nsx, self.nst)
+            self.p_axes = (tensor(xi.reshape(grid_shape)[:, 0]),
+                           tensor(ti.reshape(grid_shape)[0]))
+        else:
+            self.p_axes = None
 
         self.n_interior = len(self.p_samples[0])
         self.rng_interior = np.arange(self.n_interior)
         self.sample_size = int(self.sample_frac*self.n_interior)
 
-        # Boundary samples
+        # Boundary samples, the first n_initial are on the initial edge.
         if nbs is None:
             nbsx, nbst = self.nsx, self.nst
         else:
             nbsx, nbst = self._get_points_split((xR - xL), T, nbs)
 
         xb, tb = self._get_boundary_nodes(xL, xR, T, nbsx, nbst)
+        self.n_initial = nbsx
         self.b_samples = (tensor(xb, requires_grad=True),
-                          tensor(tb, requires_grad=True))
+                          tensor(tb + t0, requires_grad=True))
+
+    def initial_edge(self):
+        '''Return the boundary samples on the initial edge, t = t0.'''
+        xb, tb = self.b_samples
+        n = self.n_initial
+        return xb[:n].detach(), tb[:n].detach()
+
+    def set_initial(self, u):
+        '''Use the values `u` at the `initial_edge` samples as the initial
+        condition instead of the `boundary_value`.  Pass None to reset.
+        '''
+        self.u_initial = None if u is None else u.detach()
+
+    def boundary_value(self, x, t):
+        '''Return the solution on the boundary given numpy arrays.'''
+        raise NotImplementedError()
+
+    def boundary_target(self):
+        ub = self.cached_target(self.boundary_value, *self.boundary())
+        if self.u_initial is not None:
+            ub = torch.cat((self.u_initial, ub[self.n_initial:]))
+        return ub
+
+    def boundary_residuals(self, nn):
+        xb, tb = self.boundary()
+        u = nn(xb, tb)
+        return u - self.boundary_target()
 
     def nodes(self):
         return self.i_nodes
@@ -165,29 +214,186 @@ class IBVP2D(PDE):
         return self.f_nodes
 
     def interior(self):
-        if abs(self.sample_frac - 1.0) < 1e-3:
-            return self.p_samples
-        else:
-            idx = np.random.choice(self.rng_interior,
-                size=self.sample_size, replace=False)
-            x, y = self.p_samples
-            return x[idx], y[idx]
+        return self.sample_arrays(*self.p_samples)
 
     def boundary(self):
         return self.b_samples
 
     def plot_points(self):
+        t0 = self.t0
         x, t = np.mgrid[self.xL:self.xR:self.nsx*1j,
-                        0.0:self.T:self.nst*1j]
+                        t0:t0 + self.T:self.nst*1j]
         return x, t
 
+    def _use_grid(self, nn, xs):
+        '''Return True if the separable grid evaluation can be used.'''
+        return (getattr(nn, 'separable', False) and
+                self.p_axes is not None and xs is self.p_samples[0])
+
     def _get_residue(self, nn):
         xs, ts = self.interior()
-        u = nn(xs, ts)
-        u, ux, ut, uxx, utt = self._compute_derivatives(u, xs, ts)
+        if self._use_grid(nn, xs):
+            u, ux, ut, uxx, utt = nn.grid_derivatives(*self.p_axes)
+        else:
+            u, ux, ut, uxx, utt = self._eval_derivatives(nn, xs, ts)
         res = self.pde(xs, ts, u, ux, ut, uxx, utt)
         return res
 
     def interior_loss(self, nn):
         res = self._get_residue(nn)
-        return (res**2).mean()
+        return self.sample_weighted(res**2).mean()
+
+
+def _fine_solve(job):
+    # Only the classes, options and states are sent to the workers, the app
+    # is made afresh in each.
+    classes, args, k, u0, state, out_dir = job
+    torch.set_num_threads(1)
+    app = IBVPApp2D(*classes)
+    return app.solve_slab(args, k, u0, state, args.n_train, out_dir)
+
+
+class IBVPApp2D(App2D):
+    '''Solve the space-time problem one time slab at a time.
+
+    The duration is split into `--slabs` equal windows.  Each slab uses the
+    solution of the previous one at its end as the initial condition and
+    starts from the previous model moved forward in time.  With
+    `--parareal` the slabs are instead trained concurrently: a cheap coarse
+    sweep with `--coarse-train` iterations per slab provides the initial
+    conditions, the slabs are then trained in parallel and the initial
+    conditions corrected with the parareal update
+    U[k+1] = G(U[k]) + F(U_old[k]) - G(U_old[k]).
+    '''
+
+    def setup_argparse(self, **kw):
+        p = super().setup_argparse(**kw)
+        p.add_argument(
+            '--slabs', dest='slabs',
+            default=kw.get('slabs', 1), type=int,
+            help='Number of time slabs to split the duration into.'
+        )
+        p.add_argument(
+            '--parareal', dest='parareal',
+            default=kw.get('parareal', 0), type=int,
+            help='Number of parareal iterations (0 trains the slabs '
+            'sequentially).'
+        )
+        p.add_argument(
+            '--coarse-train', dest='coarse_train',
+            default=kw.get('coarse_train', 100), type=int,
+            help='Training iterations per slab for the coarse parareal '
+            'sweep.'
+        )
+        p.add_argument(
+            '--workers', dest='workers',
+            default=kw.get('workers', None), type=int,
+            help='Number of processes for the parareal slabs (defaults to '
+            'the number of CPUs).'
+        )
+        return p
+
+    def _slab_dir(self, args, k):
+        if args.directory is None:
+            return None
+        return os.path.join(args.directory, 'slab_%02d' % k)
+
+    def solve_slab(self, args, k, u0, state, n_train, out_dir=None):
+        '''Train slab `k` with initial values `u0` (None uses the exact
+        initial condition) starting from the model `state` of the previous
+        slab moved forward in time by the slab duration and return the
+        trained state and the solution at the end of the slab.
+        '''
+        activation = self._get_activation(args)
+        pde = self.pde_cls.from_args(args)
+        pde.diff_backend = args.diff_backend
+        T = args.T/args.slabs
+        pde.set_time_window(k*T, T)
+        if u0 is not None:
+            pde.set_initial(tensor(u0))
+        self.pde = pde
+        nn = self.nn_cls.from_args(pde, activation, args).to(device())
+        if state is not None:
+            load_resized(nn, state)
+            nn.shift_time(T)
+        self.nn = nn
+        plotter = self.plotter_cls.from_args(pde, nn, args)
+        self.plotter = plotter
+        solver = self.optimizer.from_args(pde, nn, plotter, args)
+        solver.n_train = n_train
+        solver.out_dir = out_dir
+        self.solver = solver
+
+        print("Slab %d: t in [%g, %g]" % (k, pde.t0, pde.t0 + T))
+        solver.solve()
+        if out_dir is not None:
+            solver.save()
+        x, t = pde.initial_edge()
+        u1 = nn(x, t + T).detach().cpu().numpy()
+        state = {k: v.detach().cpu() for k, v in nn.state_dict().items()}
+        return state, u1
+
+    def _sequential(self, args):
+        u0, state = None, None
+        for k in range(args.slabs):
+            state, u0 = self.solve_slab(
+                args, k, u0, state, args.n_train, self._slab_dir(args, k)
+            )
+
+    def _parareal(self, args):
+        n = args.slabs
+        U = [None]*(n + 1)
+        G = [None]*n
+        # The coarse and fine solves always start from the same states so
+        # that the propagators only depend on the initial condition.
+        init = [None]*n
+        for k in range(n):
+            state, G[k] = self.solve_slab(
+                args, k, U[k], init[k], args.coarse_train
+            )
+            U[k + 1] = G[k]
+            if k + 1 < n:
+                init[k + 1] = state
+
+        ctx = multiprocessing.get_context('fork')
+        classes = (self.pde_cls, self.nn_cls, self.plotter_cls, self.optimizer)
+        for it in range(args.parareal):
+            jobs = [
+                (classes, args, k, U[k], init[k], self._slab_dir(args, k))
+                for k in range(n)
+            ]
+            with ctx.Pool(args.workers) as pool:
+                fine = pool.map(_fine_solve, jobs)
+            change = 0.0
+            for k in range(n):
+                F = fine[k][1]
+                _, g = self.solve_slab(
+                    args, k, U[k], init[k], args.coarse_train
+                )
+                u1 = g + F - G[k]
+                change = max(change, np.abs(u1 - U[k + 1]).max())
+                U[k + 1], G[k] = u1, g
+            print("Parareal iteration %d: change %.3e" % (it + 1, change))
+
+    def run(self, args=None, **kw):
+        parser = self.setup_argparse(**kw)
+        opts = parser.parse_args(args)
+        if opts.slabs <= 1:
+            return super().run(args, **kw)
+        args = opts
+        if not hasattr(self.nn_cls, 'shift_time'):
+            raise ValueError(
+                f'{self.nn_cls.__name__} does not support --slabs.'
+            )
+
+        if args.gpu:
+            device("cuda")
+        else:
+            device("cpu")
+
+        if args.parareal > 0:
+            if args.gpu:
+                raise ValueError('--parareal is not supported on the GPU.')
+            self._parareal(args)
+        else:
+            self._sequential(args)
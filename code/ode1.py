@@ -3,7 +3,6 @@
 
 import numpy as np
 
-from common import tensor
 from spinn1d import Plotter1D, SPINN1D, App1D
 from ode_base import BasicODE
 
@@ -17,11 +16,11 @@ class ODESimple(BasicODE):
     def exact(self, x):
         return 0.5*x*(1.0 - x)
 
-    def boundary_loss(self, nn):
-        u = nn(self.boundary())
-        ub = tensor(self.exact(self.xbn))
-        bc = u - ub
-        return (bc**2).sum()
+    def boundary_residuals(self, nn):
+        xb = self.boundary()
+        u = nn(xb)
+        ub = self.cached_target(self.exact, xb)
+        return (u - ub)
 
     def plot_points(self):
         n = 25
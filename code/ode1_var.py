@@ -3,7 +3,6 @@
 
 import numpy as np
 
-from common import tensor
 from spinn1d import Plotter1D, SPINN1D, App1D
 from var1d_base import Var1D
 
@@ -21,11 +20,11 @@ class ODESimple(Var1D):
     #     res = self._get_residue(nn)
     #     return res.sum()
 
-    def boundary_loss(self, nn):
-        u = nn(self.boundary())
-        ub = tensor(self.exact(self.xbn))
-        bc = u - ub
-        return 1000*(bc**2).sum()
+    def boundary_residuals(self, nn):
+        xb = self.boundary()
+        u = nn(xb)
+        ub = self.cached_target(self.exact, xb)
+        return np.sqrt(1000)*(u - ub)
 
     def plot_points(self):
         n = 25
@@ -23,9 +23,12 @@ class Neumann1D(BasicODE):
 
     def interior_loss(self, nn):
         res = self._get_residue(nn)
-        return (res**2).sum()
+        return self.sample_weighted(res**2).sum()
 
-    def boundary_loss(self, nn):
+    def interior_residuals(self, nn):
+        return self.sample_root_weighted(self._get_residue(nn), mean=False)
+
+    def boundary_residuals(self, nn):
         x = self.boundary()
         x.requires_grad = True
         u = nn(x)
@@ -37,7 +40,7 @@ class Neumann1D(BasicODE):
         dbc = (u - ub)[:1]
         nbc = (du[0] - ub)[1:]
         bc = torch.cat((dbc, nbc))
-        return 50*(bc**2).sum()
+        return np.sqrt(50)*bc
 
     def plot_points(self):
         n = 25
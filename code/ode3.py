@@ -4,7 +4,6 @@
 import numpy as np
 import torch
 
-from common import tensor
 from spinn1d import Plotter1D, SPINN1D, App1D
 from ode_base import BasicODE
 
@@ -23,11 +22,11 @@ class ODESimple(BasicODE):
         return x*(np.exp(-((x - (1.0/3.0))**2)/K) -
                   np.exp(-4.0/(9.0*K)))
 
-    def boundary_loss(self, nn):
-        u = nn(self.boundary())
-        ub = tensor(self.exact(self.xbn))
-        bc = u - ub
-        return 10*(bc**2).sum()
+    def boundary_residuals(self, nn):
+        xb = self.boundary()
+        u = nn(xb)
+        ub = self.cached_target(self.exact, xb)
+        return np.sqrt(10)*(u - ub)
 
     def plot_points(self):
         n = 50
@@ -26,11 +26,10 @@ class ODESimple(Var1D):
         return x*(np.exp(-((x - (1.0/3.0))**2)/K) -
                   np.exp(-4.0/(9.0*K)))
 
-    def boundary_loss(self, nn):
+    def boundary_residuals(self, nn):
         u = nn(self.boundary())
         ub = tensor(self.exact(self.xbn))
-        bc = u - ub
-        return (bc**2).sum()
+        return u - ub
 
     def plot_points(self):
         n = 50
@@ -2,7 +2,6 @@
 
 import numpy as np
 import torch
-import torch.autograd as ag
 from common import PDE, tensor
 
 class BasicODE(PDE):
@@ -29,18 +28,6 @@ class BasicODE(PDE):
             help='Fraction of interior nodes used for sampling.'
         )
 
-    def _compute_derivatives(self, u, x):
-        du = ag.grad(
-            outputs=u, inputs=x, grad_outputs=torch.ones_like(u),
-            retain_graph=True, create_graph=True, allow_unused=True
-        )
-
-        d2u = ag.grad(
-            outputs=du, inputs=x, grad_outputs=torch.ones_like(du[0]),
-            retain_graph=True, create_graph=True, allow_unused=True
-        )
-        return u, du[0], d2u[0]
-
     def __init__(self, n, ns, sample_frac=1.0):
         self.n = n
         self.ns = ns
@@ -65,12 +52,7 @@ class BasicODE(PDE):
         return self.xbn
 
     def interior(self):
-        if abs(self.sample_frac - 1.0) < 1e-3:
-            return self.xs
-        else:
-            idx = np.random.choice(self.rng_interior, 
-                size=self.sample_size, replace=False)
-            return self.xs[idx]
+        return self.sample_arrays(self.xs)[0]
 
     def boundary(self):
         return self.xb
@@ -82,11 +64,10 @@ class BasicODE(PDE):
 
     def _get_residue(self, nn):
         xs = self.interior()
-        u = nn(xs)
-        u, ux, uxx = self._compute_derivatives(u, xs)
+        u, ux, uxx = self._eval_derivatives(nn, xs)
         res = self.pde(xs, u, ux, uxx)
         return res
 
     def interior_loss(self, nn):
         res = self._get_residue(nn)
-        return (res**2).mean()
\ No newline at end of file
+        return self.sample_weighted(res**2).mean()
\ No newline at end of file
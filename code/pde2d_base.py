@@ -2,17 +2,20 @@
 
 import numpy as np
 import torch
-import torch.autograd as ag
 from common import PDE, tensor
+from samplers import box_points
 from spinn2d import Plotter2D, SPINN2D, App2D
 
 
 class RegularPDE(PDE):
+    # Axes of the interior samples when they form a tensor product grid.
+    p_axes = None
+
     @classmethod
     def from_args(cls, args):
         return cls(args.nodes, args.samples,
                    args.b_nodes, args.b_samples,
-                   args.sample_frac)
+                   args.sample_frac, args.sampler)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -42,26 +45,15 @@ class RegularPDE(PDE):
             default=kw.get('sample_frac', 1.0), type=float,
             help='Fraction of interior nodes used for sampling.'
         )
-
-    def _compute_derivatives(self, u, xs, ys):
-        du = ag.grad(
-            outputs=u, inputs=(xs, ys), grad_outputs=torch.ones_like(u),
-            retain_graph=True, create_graph=True
-        )
-        d2ux = ag.grad(
-            outputs=du[0], inputs=(xs, ys),
-            grad_outputs=torch.ones_like(du[0]),
-            retain_graph=True, create_graph=True
-        )
-        d2uy = ag.grad(
-            outputs=du[1], inputs=(xs, ys),
-            grad_outputs=torch.ones_like(du[1]),
-            retain_graph=True, create_graph=True
+        p.add_argument(
+            '--sampler', dest='sampler',
+            default=kw.get('sampler', 'grid'),
+            choices=['grid', 'sobol', 'halton', 'lhs'],
+            help='Point set used for the interior samples.'
         )
 
-        return u, du[0], du[1], d2ux[0],  d2uy[1]
-
-    def __init__(self, n_nodes, ns, nb=None, nbs=None, sample_frac=1.0):
+    def __init__(self, n_nodes, ns, nb=None, nbs=None, sample_frac=1.0,
+                 sampler='grid'):
         self.sample_frac = sample_frac
 
         # Interior nodes
@@ -87,9 +79,13 @@ class RegularPDE(PDE):
         self.ns = ns = round(np.sqrt(ns) + 0.49)
         dxb2 = 0.5/(ns)
         xl, xr = dxb2, 1.0 - dxb2
-        sl = slice(xl, xr, ns*1j)
-        xs, ys = (tensor(t.ravel(), requires_grad=True)
-                  for t in np.mgrid[sl, sl])
+        if sampler == 'grid':
+            sl = slice(xl, xr, ns*1j)
+            x, y = np.mgrid[sl, sl]
+            self.p_axes = (tensor(x[:, 0]), tensor(y[0]))
+        else:
+            x, y = box_points(ns*ns, (0.0, 0.0), (1.0, 1.0), sampler)
+        xs, ys = (tensor(t.ravel(), requires_grad=True) for t in (x, y))
         self.p_samples = (xs, ys)
 
         self.n_interior = len(self.p_samples[0])
@@ -113,13 +109,7 @@ class RegularPDE(PDE):
         return self.f_nodes
 
     def interior(self):
-        if abs(self.sample_frac - 1.0) < 1e-3:
-            return self.p_samples
-        else:
-            idx = np.random.choice(self.rng_interior, 
-                size=self.sample_size, replace=False)
-            x, y = self.p_samples
-            return x[idx], y[idx]
+        return self.sample_arrays(*self.p_samples)
 
     def boundary(self):
         return self.b_samples
@@ -129,13 +119,20 @@ class RegularPDE(PDE):
         x, y = np.mgrid[0:1:n*1j, 0:1:n*1j]
         return x, y
 
+    def _use_grid(self, nn, xs):
+        '''Return True if the separable grid evaluation can be used.'''
+        return (getattr(nn, 'separable', False) and
+                self.p_axes is not None and xs is self.p_samples[0])
+
     def _get_residue(self, nn):
         xs, ys = self.interior()
-        u = nn(xs, ys)
-        u, ux, uy, uxx, uyy = self._compute_derivatives(u, xs, ys)
+        if self._use_grid(nn, xs):
+            u, ux, uy, uxx, uyy = nn.grid_derivatives(*self.p_axes)
+        else:
+            u, ux, uy, uxx, uyy = self._eval_derivatives(nn, xs, ys)
         res = self.pde(xs, ys, u, ux, uy, uxx, uyy)
         return res
 
     def interior_loss(self, nn):
         res = self._get_residue(nn)
-        return (res**2).mean()
\ No newline at end of file
+        return self.sample_weighted(res**2).mean()
\ No newline at end of file
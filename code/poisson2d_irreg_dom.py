@@ -3,9 +3,9 @@
 import os
 import numpy as np
 import torch
-import torch.autograd as ag
 from mayavi import mlab
 from common import PDE, tensor
+from samplers import box_points, nearest_mask
 from spinn2d import Plotter2D, App2D, SPINN2D
 
 
@@ -14,7 +14,7 @@ class Poisson2D(PDE):
     def from_args(cls, args):
         return cls(args.f_nodes_int, args.f_nodes_bdy,
             args.f_samples_int, args.f_samples_bdy,
-            args.sample_frac)
+            args.sample_frac, args.sampler)
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -52,25 +52,14 @@ class Poisson2D(PDE):
             default=kw.get('sample_frac', 1.0), type=float,
             help='Fraction of interior nodes used for sampling.'
         )
-
-    def _compute_derivatives(self, u, xs, ys):
-        du = ag.grad(
-            outputs=u, inputs=(xs, ys), grad_outputs=torch.ones_like(u),
-            retain_graph=True, create_graph=True
-        )
-        d2ux = ag.grad(
-            outputs=du[0], inputs=(xs, ys),
-            grad_outputs=torch.ones_like(du[0]),
-            retain_graph=True, create_graph=True
-        )
-        d2uy = ag.grad(
-            outputs=du[1], inputs=(xs, ys),
-            grad_outputs=torch.ones_like(du[1]),
-            retain_graph=True, create_graph=True
+        p.add_argument(
+            '--sampler', dest='sampler',
+            default=kw.get('sampler', 'grid'),
+            choices=['grid', 'sobol', 'halton', 'lhs'],
+            help='Point set used for the interior samples, grid uses the '
+            'samples in the file.'
         )
 
-        return u, du[0], du[1], d2ux[0],  d2uy[1]
-
     def _extract_coordinates(self, f_pts):
         xs = []
         ys = []
@@ -91,7 +80,7 @@ class Poisson2D(PDE):
     def __init__(self,
         f_nodes_int, f_nodes_bdy,
         f_samples_int, f_samples_bdy,
-        sample_frac=1.0):
+        sample_frac=1.0, sampler='grid'):
 
         self.f_nodes_int = f_nodes_int
         self.f_nodes_bdy = f_nodes_bdy
@@ -111,6 +100,14 @@ class Poisson2D(PDE):
 
         ## Interior samples
         xi, yi = self._extract_coordinates(f_samples_int)
+        xbs, ybs = self._extract_coordinates(f_samples_bdy)
+        if sampler != 'grid':
+            # Keep the points nearer the file's interior samples than its
+            # boundary samples.
+            x, y = np.hstack((xi, xbs)), np.hstack((yi, ybs))
+            mask = nearest_mask((xi, yi), (xbs, ybs))
+            xi, yi = box_points(len(xi), (x.min(), y.min()),
+                                (x.max(), y.max()), sampler, mask=mask)
         self.interior_samples = (tensor(xi, requires_grad=True),
                                  tensor(yi, requires_grad=True))
 
@@ -119,9 +116,8 @@ class Poisson2D(PDE):
         self.sample_size = int(self.sample_frac*self.n_interior)
 
         ## Boundary samples
-        xb, yb = self._extract_coordinates(f_samples_bdy)
-        self.boundary_samples = (tensor(xb, requires_grad=True),
-                                 tensor(yb, requires_grad=True))
+        self.boundary_samples = (tensor(xbs, requires_grad=True),
+                                 tensor(ybs, requires_grad=True))
 
     def nodes(self):
         return self.interior_nodes
@@ -130,13 +126,7 @@ class Poisson2D(PDE):
         return self.boundary_nodes
 
     def interior(self):
-        if abs(self.sample_frac - 1.0) < 1e-3:
-            return self.interior_samples
-        else:
-            idx = np.random.choice(self.rng_interior,
-                size=self.sample_size, replace=False)
-            x, y = self.interior_samples
-            return x[idx], y[idx]
+        return self.sample_arrays(*self.interior_samples)
 
     def boundary(self):
         return self.boundary_samples
@@ -153,21 +143,19 @@ class Poisson2D(PDE):
 
     def _get_residue(self, nn):
         xs, ys = self.interior()
-        u = nn(xs, ys)
-        u, ux, uy, uxx, uyy = self._compute_derivatives(u, xs, ys)
+        u, ux, uy, uxx, uyy = self._eval_derivatives(nn, xs, ys)
         res = self.pde(xs, ys, u, ux, uy, uxx, uyy)
         return res
 
     def interior_loss(self, nn):
         res = self._get_residue(nn)
-        return (res**2).mean()
+        return self.sample_weighted(res**2).mean()
 
-    def boundary_loss(self, nn):
+    def boundary_residuals(self, nn):
         xb, tb = self.boundary()
         u = nn(xb, tb)
         ub = 0.0
-        bc = u - ub
-        return (bc**2).sum()
+        return u - ub
 
 
 def _vtu2data(fname):
@@ -196,11 +184,8 @@ def _get_errors(nn, fvtu):
 
 class PointCloud(Plotter2D):
     def get_plot_data(self):
-        x, y = self.pde.plot_points()
-        pn = self.nn(x, y).detach().cpu().numpy()
-        pn.shape = x.shape
-        xn = x.detach().cpu().numpy()
-        yn = y.detach().cpu().numpy()
+        (xn, yn), pn = self.evaluator.solution()
+        pn.shape = xn.shape
         return xn, yn, pn
 
     def plot_solution(self):
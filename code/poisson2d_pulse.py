@@ -6,7 +6,6 @@
 import numpy as np
 import torch
 
-from common import tensor
 from spinn2d import Plotter2D, SPINN2D, App2D
 from pde2d_base import RegularPDE
 
@@ -30,14 +29,11 @@ class Poisson2D(RegularPDE):
         K = 0.02
         return x*(1.0 - x)*y*(1.0 - y)*np.exp(-(x - 0.25)*(x - 0.25)/K)
 
-    def boundary_loss(self, nn):
+    def boundary_residuals(self, nn):
         xb, yb = self.boundary()
-        xbn, ybn = (t.detach().cpu().numpy() for t in (xb, yb))
-
         u = nn(xb, yb)
-        ub = tensor(self.exact(xbn, ybn))
-        bc = u - ub
-        return (bc**2).sum()
+        ub = self.cached_target(self.exact, xb, yb)
+        return u - ub
 
 if __name__ == '__main__':
     app = App2D(
@@ -3,6 +3,7 @@ import torch
 import os
 
 from common import tensor
+from samplers import box_points
 from pde2d_base import RegularPDE
 from spinn2d import Plotter2D, App2D, SPINN2D
 
@@ -10,7 +11,8 @@ from mayavi import mlab
 
 
 class SquareSlit(RegularPDE):
-    def __init__(self, n_nodes, ns, nb=None, nbs=None, sample_frac=1.0):
+    def __init__(self, n_nodes, ns, nb=None, nbs=None, sample_frac=1.0,
+                 sampler='grid'):
         self.sample_frac = sample_frac
 
         # Interior nodes
@@ -38,11 +40,20 @@ class SquareSlit(RegularPDE):
         self.ns = ns = round(np.sqrt(ns) + 0.49)
         dxb2 = 1.0/(ns)
         xl, xr = dxb2 - 1.0, 1.0 - dxb2
+
+        def outside_slit(x, y):
+            return ~((x >= 0) & (np.abs(y) < dxb2))
+
         sl = slice(xl, xr, ns*1j)
         x, y = np.mgrid[sl, sl]
-        cond = ~((x >= 0) & (np.abs(y) < dxb2))
+        cond = outside_slit(x, y)
+        if sampler == 'grid':
+            x, y = x[cond], y[cond]
+        else:
+            x, y = box_points(np.count_nonzero(cond), (-1.0, -1.0),
+                              (1.0, 1.0), sampler, mask=outside_slit)
         xs, ys = (tensor(t.ravel(), requires_grad=True)
-                  for t in (x[cond], y[cond]))
+                  for t in (x, y))
         self.p_samples = (xs, ys)
 
         self.n_interior = len(self.p_samples[0])
@@ -73,12 +84,11 @@ class SquareSlit(RegularPDE):
     def has_exact(self):
         return False
 
-    def boundary_loss(self, nn):
+    def boundary_residuals(self, nn):
         xb, yb = self.boundary()
         u = nn(xb, yb)
         ub = 0.0
-        bc = u - ub
-        return (bc**2).sum()
+        return u - ub
 
 
 def _vtu2data(fname):
@@ -119,7 +129,7 @@ class FEM(Plotter2D):
         x = pts[:,0]
         y = pts[:,1]
         xt, yt = tensor(x.ravel()), tensor(y.ravel())
-        u = self.nn(xt, yt).detach().cpu().numpy()
+        u = self.evaluator(xt, yt).cpu().numpy()
         u.shape = x.shape
 
         du = u - u_exact
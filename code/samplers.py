@@ -0,0 +1,158 @@
+# Quasi random point sets for the collocation samples.
+
+import numpy as np
+import torch
+
+
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19)
+
+
+def _radical_inverse(i, base):
+    '''Return the van der Corput radical inverse of the integers `i`.'''
+    i = np.array(i)
+    f = 1.0
+    r = np.zeros(len(i))
+    while np.any(i > 0):
+        f /= base
+        r += f*(i % base)
+        i //= base
+    return r
+
+
+def unit_points(n, dim, kind, seed=0):
+    '''Return `n` points in the unit cube of dimension `dim` as an (n, dim)
+    array.
+
+    `kind` is one of 'sobol' (scrambled Sobol sequence), 'halton' (Halton
+    sequence with a random shift) or 'lhs' (Latin hypercube).
+    '''
+    rng = np.random.default_rng(seed)
+    if kind == 'sobol':
+        engine = torch.quasirandom.SobolEngine(dim, scramble=True, seed=seed)
+        return engine.draw(n, dtype=torch.float64).numpy()
+    elif kind == 'halton':
+        i = np.arange(1, n + 1)
+        pts = np.stack([_radical_inverse(i, b) for b in PRIMES[:dim]], axis=1)
+        return (pts + rng.random(dim)) % 1.0
+    elif kind == 'lhs':
+        perm = np.stack([rng.permutation(n) for _ in range(dim)], axis=1)
+        return (perm + rng.random((n, dim)))/n
+    else:
+        raise ValueError(f'Unknown point set {kind}.')
+
+
+def box_points(n, lo, hi, kind, mask=None, seed=0):
+    '''Return `n` points of the given `kind` in the box with corners `lo`
+    and `hi` as a tuple of coordinate arrays.
+
+    If `mask` is given only the points for which `mask(*coords)` is True
+    are kept and more points of the sequence are drawn until there are `n`
+    of them.
+    '''
+    lo, hi = np.asarray(lo, dtype=float), np.asarray(hi, dtype=float)
+    m = n
+    for i in range(20):
+        pts = lo + unit_points(m, len(lo), kind, seed)*(hi - lo)
+        coords = tuple(pts.T)
+        if mask is not None:
+            keep = mask(*coords)
+            coords = tuple(c[keep] for c in coords)
+        n_found = len(coords[0])
+        if n_found >= n:
+            return tuple(c[:n] for c in coords)
+        m = int(1.1*m*n/max(n_found, 1)) + 1
+    raise RuntimeError('Could not find enough points inside the mask.')
+
+
+def nearest_mask(inside, outside):
+    '''Return a mask that keeps the points closer to one of the `inside`
+    points than to any of the `outside` points (both tuples of coordinate
+    arrays).  With samples inside a domain and on its boundary this selects
+    points in the domain whatever its shape.
+    '''
+    pi = torch.as_tensor(np.stack(inside, axis=1), dtype=torch.float64)
+    po = torch.as_tensor(np.stack(outside, axis=1), dtype=torch.float64)
+
+    def mask(*coords):
+        p = torch.as_tensor(np.stack(coords, axis=1), dtype=torch.float64)
+        keep = []
+        for chunk in torch.split(p, 4096):
+            di = torch.cdist(chunk, pi).min(dim=1).values
+            do = torch.cdist(chunk, po).min(dim=1).values
+            keep.append(di < do)
+        return torch.cat(keep).numpy()
+
+    return mask
+
+
+class BatchSampler:
+    '''Serve batches of `size` indices into `n` samples on the `device`.
+
+    The indices are permuted once per pass over the samples and contiguous
+    slices of the permutation are served, so no sample is repeated within
+    an epoch.  With mode 'epoch' the permutation is random.  With mode
+    'sobol' the samples are ranked by the points of a scrambled Sobol
+    sequence so each batch is spread evenly over the samples.  `weighted`
+    draws indices with the given probabilities.  The state is saved and
+    restored with `state_dict` and `load_state_dict` so runs can be
+    reproduced.
+    '''
+    def __init__(self, n, size, mode='epoch', seed=None, device='cpu'):
+        self.n = n
+        self.size = size
+        self.mode = mode
+        self.generator = torch.Generator(device=device)
+        if seed is None:
+            seed = self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        self.seed = seed
+        self.perm = torch.empty(0, dtype=torch.long, device=device)
+        self.pos = 0
+        if mode == 'sobol':
+            self.sobol = torch.quasirandom.SobolEngine(
+                1, scramble=True, seed=seed % 2**63
+            )
+        elif mode != 'epoch':
+            raise ValueError(f'Unknown batch sampler {mode}.')
+
+    def _permutation(self):
+        dev = self.perm.device
+        if self.mode == 'sobol':
+            u = self.sobol.draw(self.n).squeeze(1)
+            return torch.argsort(torch.argsort(u)).to(dev)
+        return torch.randperm(self.n, generator=self.generator, device=dev)
+
+    def draw(self):
+        if self.pos + self.size > len(self.perm):
+            self.perm = self._permutation()
+            self.pos = 0
+        idx = self.perm[self.pos:self.pos + self.size]
+        self.pos += self.size
+        return idx
+
+    def weighted(self, prob):
+        return torch.multinomial(
+            prob, self.size, replacement=True, generator=self.generator
+        )
+
+    def state_dict(self):
+        state = dict(
+            n=self.n, size=self.size, mode=self.mode, seed=self.seed,
+            generator=self.generator.get_state(), perm=self.perm.cpu(),
+            pos=self.pos
+        )
+        if self.mode == 'sobol':
+            state['sobol_generated'] = self.sobol.num_generated
+        return state
+
+    def load_state_dict(self, state):
+        self.__init__(
+            state['n'], state['size'], state['mode'], state['seed'],
+            self.perm.device
+        )
+        self.generator.set_state(state['generator'])
+        self.perm = state['perm'].to(self.perm.device)
+        self.pos = state['pos']
+        if self.mode == 'sobol':
+            self.sobol.fast_forward(state['sobol_generated'])
@@ -1,3 +1,4 @@
+import copy
 import os
 
 import numpy as np
@@ -5,7 +6,10 @@ import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 
-from common import Plotter, App, tensor
+from common import (
+    Plotter, App, KernelTable, device, load_resized, minimize_quadratic,
+    removal_change, resize_parameter, tensor
+)
 
 
 class Plotter1D(Plotter):
@@ -14,7 +18,7 @@ class Plotter1D(Plotter):
             return 0.0, 0.0, 0.0
 
         if xn is None and pn is None:
-            xn, pn = self.get_plot_data()
+            return self.evaluator.errors()
 
         yn = self.pde.exact(xn)
         diff = yn - pn
@@ -36,9 +40,7 @@ class Plotter1D(Plotter):
 
     # Plotting methods
     def get_plot_data(self):
-        x = self.pde.plot_points()
-        xt = tensor(x)
-        pn = self.nn(xt).detach().cpu().numpy()
+        (x,), pn = self.evaluator.solution()
         return x, pn
 
     def plot_solution(self):
@@ -101,12 +103,18 @@ class Shift(nn.Module):
             xmin, xmax = np.min(points), np.max(points)
         dx = (xmax - xmin)/n
         self.center = nn.Parameter(tensor(points))
-        self.fixed = tensor(fixed_points)
+        self.register_buffer('fixed', tensor(fixed_points))
         if fixed_h:
             self.h = nn.Parameter(torch.tensor(dx))
         else:
             self.h = nn.Parameter(dx*torch.ones(n))
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kw):
+        # Models saved before the fixed nodes were recorded do not have them,
+        # keep the fixed nodes of the problem for those.
+        state_dict.setdefault(prefix + 'fixed', self.fixed)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kw)
+
     def centers(self):
         return torch.cat((self.center, self.fixed))
 
@@ -118,8 +126,12 @@ class Shift(nn.Module):
 class SPINN1D(nn.Module):
     @classmethod
     def from_args(cls, pde, activation, args):
-        return cls(pde, activation,
-                   fixed_h=args.fixed_h, use_pu=args.pu)
+        nn = cls(pde, activation,
+                 fixed_h=args.fixed_h, use_pu=args.pu,
+                 closed_form=args.closed_form)
+        if args.init_from:
+            nn.init_from(args.init_from, pde)
+        return nn
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -132,12 +144,30 @@ class SPINN1D(nn.Module):
             '--pu', dest='pu', action='store_true', default=False,
             help='Use a partition of unity.'
         )
+        p.add_argument(
+            '--closed-form', dest='closed_form', action='store_true',
+            default=kw.get('closed_form', False),
+            help='Compute the derivatives of the solution analytically '
+            '(gaussian and softplus activations only).'
+        )
+        p.add_argument(
+            '--init-from', dest='init_from',
+            default=kw.get('init_from', None),
+            help='Initialize from a saved model.pt that may have a different '
+            'number of nodes.'
+        )
 
-    def __init__(self, pde, activation, fixed_h=False, use_pu=False):
+    def __init__(self, pde, activation, fixed_h=False, use_pu=False,
+                 closed_form=False):
         super().__init__()
 
+        if closed_form and not hasattr(activation, 'derivatives'):
+            raise ValueError(
+                'Activation does not support closed form derivatives.'
+            )
         self.fixed_h = fixed_h
         self.use_pu = use_pu
+        self.closed_form = closed_form
         self.layer1 = Shift(pde.nodes(), pde.fixed_nodes(),
                             fixed_h=fixed_h)
         n = self.layer1.n
@@ -158,6 +188,25 @@ class SPINN1D(nn.Module):
         y = self.layer2(y/y1)
         return y.squeeze()
 
+    def derivatives(self, x):
+        '''Return (u, u_x, u_xx) at the given points computed from the
+        analytical derivatives of the activation.
+        '''
+        xh = self.layer1(x.unsqueeze(1))
+        fac = 1.0/self.layer1.h
+        y, yx, yxx = self.activation.derivatives(xh)
+        w = self.layer2.weight.T
+        u, ux, uxx = y @ w, (yx*fac) @ w, (yxx*fac*fac) @ w
+        if self.use_pu:
+            one = torch.ones_like(w[:, :1])
+            d, dx, dxx = y @ one, (yx*fac) @ one, (yxx*fac*fac) @ one
+            u = u/d
+            ux = (ux - u*dx)/d
+            uxx = (uxx - 2.0*ux*dx - u*dxx)/d
+        else:
+            u = u + self.layer2.bias
+        return u.squeeze(), ux.squeeze(), uxx.squeeze()
+
     def centers(self):
         return self.layer1.centers()
 
@@ -167,6 +216,106 @@ class SPINN1D(nn.Module):
     def weights(self):
         return self.layer2.weight
 
+    def linear_parameters(self):
+        return self.layer2.parameters()
+
+    def init_from(self, fname, pde):
+        '''Initialize from the model saved in `fname` which may have a
+        different number of nodes.
+
+        The free centers are placed at the same quantiles as the saved ones,
+        the widths are interpolated from the saved widths and scaled by the
+        ratio of the number of nodes, and the weights are the least squares
+        fit to the saved solution at (at least four per node) uniformly
+        spaced points spanning the plot points of the `pde`.
+        '''
+        coarse = copy.deepcopy(self)
+        load_resized(coarse, torch.load(fname, map_location=device()))
+        l1, cl1 = self.layer1, coarse.layer1
+        # load_resized only replaces the tensors so set the node count.
+        cl1.n = coarse.layer2.in_features = len(cl1.center) + len(cl1.fixed)
+        with torch.no_grad():
+            for name, value in coarse.state_dict().items():
+                dest = self.state_dict()[name]
+                if value.shape == dest.shape and not name.startswith('layer'):
+                    dest.copy_(value)
+            cc, order = torch.sort(cl1.center)
+            n_c = len(cc)
+            if n_c > 1:
+                q = torch.linspace(
+                    0, n_c - 1, len(l1.center), device=cc.device
+                )
+                k = torch.clamp(q.long(), max=n_c - 2)
+                t = (q - k).to(cc)
+                l1.center[torch.argsort(l1.center)] = (
+                    (1.0 - t)*cc[k] + t*cc[k + 1]
+                )
+            fac = cl1.n/l1.n
+            if self.fixed_h:
+                l1.h.copy_(cl1.h*fac)
+            else:
+                c = cl1.centers()
+                nearest = torch.argmin(
+                    torch.abs(l1.centers().unsqueeze(1) - c), dim=1
+                )
+                l1.h.copy_(cl1.h[nearest]*fac)
+
+        # Fit on enough points to determine the weights of all the nodes.
+        xp = pde.plot_points()
+        n_fit = max(len(xp), 4*l1.n)
+        x = tensor(np.linspace(np.min(xp), np.max(xp), n_fit))
+        with torch.no_grad():
+            uc = coarse(x)
+        loss = ((self(x) - uc)**2).mean()
+        minimize_quadratic(loss, list(self.layer2.parameters()))
+
+    def _resize_nodes(self, index, x=None, h=None, w=None, optimizer=None):
+        l1 = self.layer1
+        n_free = len(l1.center)
+        fixed = torch.arange(n_free, l1.n, device=index.device)
+        full = torch.cat((index, fixed))
+        resize_parameter(l1.center, index, x, optimizer=optimizer)
+        if not self.fixed_h:
+            resize_parameter(l1.h, full, h, optimizer=optimizer)
+        resize_parameter(
+            self.layer2.weight, full, w, dim=1, optimizer=optimizer
+        )
+        l1.n = self.layer2.in_features = len(full)
+
+    def remove_nodes(self, keep, optimizer=None):
+        '''Remove the free nodes that are False in the mask `keep` which is
+        given for all the nodes.  Fixed nodes are never removed.
+        '''
+        n_free = len(self.layer1.center)
+        index = torch.nonzero(keep[:n_free]).squeeze(1)
+        self._resize_nodes(index, optimizer=optimizer)
+
+    def removal_change(self, x):
+        '''Return the root mean square change of the solution at the points
+        `x` when each node is removed by itself.
+        '''
+        with torch.no_grad():
+            z = self.activation(self.layer1(x.unsqueeze(1)))
+            return removal_change(z, self.layer2.weight.T, self.use_pu)
+
+    def insert_nodes(self, x, optimizer=None):
+        '''Insert free nodes at `x` with the width of the nearest existing
+        node.  Their weight is zero, or the current solution at `x` with a
+        partition of unity so that the solution changes little.
+        '''
+        with torch.no_grad():
+            c = self.centers()
+            h = self.widths()*torch.ones_like(c)
+            nearest = torch.argmin(torch.abs(x.unsqueeze(1) - c), dim=1)
+            hn = h[nearest]
+            wn = self(x).reshape(len(x), -1).T if self.use_pu else None
+        n_free = len(self.layer1.center)
+        index = torch.cat((
+            torch.arange(n_free, device=x.device),
+            -torch.ones(len(x), dtype=torch.long, device=x.device)
+        ))
+        self._resize_nodes(index, x, hn, wn, optimizer=optimizer)
+
     def show(self):
         print("Basis centers: ", self.centers())
         print("Mesh widths: ", self.widths())
@@ -180,6 +329,17 @@ def gaussian(x):
     return torch.exp(-0.5*x*x)
 
 
+class Gaussian:
+    def __call__(self, x):
+        return gaussian(x)
+
+    def derivatives(self, x):
+        '''Return the activation and its first and second derivatives.
+        '''
+        y = gaussian(x)
+        return y, -x*y, (x*x - 1.0)*y
+
+
 class SoftPlus:
     def __init__(self):
         self._sp = nn.Softplus()
@@ -190,6 +350,18 @@ class SoftPlus:
         sp = self._sp
         return sp(self.k - sp(2.0*x) - sp(-2.0*x))/self.fac
 
+    def derivatives(self, x):
+        '''Return the activation and its first and second derivatives.
+        '''
+        sp = self._sp
+        sx = torch.sigmoid(2.0*x)
+        g = self.k - sp(2.0*x) - sp(-2.0*x)
+        gx = 2.0 - 4.0*sx
+        gxx = -8.0*sx*(1.0 - sx)
+        s = torch.sigmoid(g)
+        fac = self.fac
+        return sp(g)/fac, s*gx/fac, (s*(1.0 - s)*gx*gx + s*gxx)/fac
+
 
 tanh = torch.tanh
 
@@ -202,8 +374,22 @@ class Kernel(nn.Module):
         self.layer1 = nn.Linear(1, n_kernel)
         self.layer2 = nn.Linear(n_kernel, n_kernel)
         self.layer3 = nn.Linear(n_kernel, 1)
+        self.table = None
+
+    def tabulate(self, size, extent):
+        '''Evaluate the kernel from a table of `size` values over
+        [-extent, extent] that is rebuilt once per parameter update.
+        '''
+        self.table = KernelTable(
+            self._forward, self.parameters, -extent, extent, size
+        )
 
     def forward(self, x):
+        if self.table is not None:
+            return self.table(x)
+        return self._forward(x)
+
+    def _forward(self, x):
         orig_shape = x.shape
         x = x.flatten().unsqueeze(1)
         x = torch.tanh(self.layer1(x))
@@ -226,12 +412,27 @@ class App1D(App):
             default=kw.get('kernel_size', 5), type=int,
             help='Activation kernel size (in place of a Gaussian).'
         )
+        p.add_argument(
+            '--kernel-table', dest='kernel_table',
+            default=kw.get('kernel_table', 0), type=int,
+            help='Tabulate the kernel activation using these many points '
+            '(0 evaluates the kernel network directly).'
+        )
+        p.add_argument(
+            '--kernel-range', dest='kernel_range',
+            default=kw.get('kernel_range', 5.0), type=float,
+            help='Initial extent of the kernel table in units of the node '
+            'width.'
+        )
 
     def _get_activation(self, args):
         activations = {
-            'gaussian': lambda x: gaussian,
+            'gaussian': lambda x: Gaussian(),
             'tanh': lambda x: tanh,
             'softplus': lambda x: SoftPlus(),
             'kernel': Kernel
         }
-        return activations[args.activation](args.kernel_size)
+        activation = activations[args.activation](args.kernel_size)
+        if args.kernel_table > 0 and args.activation == 'kernel':
+            activation.tabulate(args.kernel_table, args.kernel_range)
+        return activation
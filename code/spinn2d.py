@@ -1,3 +1,4 @@
+import copy
 import os
 import sys
 from mayavi import mlab
@@ -5,7 +6,10 @@ import numpy as np
 import torch
 import torch.nn as nn
 
-from common import App, Plotter, tensor
+from common import (
+    App, Plotter, KernelTable, device, load_resized, minimize_quadratic,
+    removal_change, resize_parameter, tensor
+)
 
 
 class Plotter2D(Plotter):
@@ -14,7 +18,7 @@ class Plotter2D(Plotter):
             return 0.0, 0.0, 0.0
 
         if xn is None and pn is None:
-            xn, yn, pn = self.get_plot_data()
+            return self.evaluator.errors()
 
         un = self.pde.exact(xn, yn)
         diff = un - pn
@@ -36,9 +40,7 @@ class Plotter2D(Plotter):
 
     # Plotting methods
     def get_plot_data(self):
-        x, y = self.pde.plot_points()
-        xt, yt = tensor(x.ravel()), tensor(y.ravel())
-        pn = self.nn(xt, yt).detach().cpu().numpy()
+        (x, y), pn = self.evaluator.solution()
         pn.shape = x.shape
         return x, y, pn
 
@@ -101,8 +103,8 @@ class Shift2D(nn.Module):
         self.x = nn.Parameter(tensor(points[0]))
         self.y = nn.Parameter(tensor(points[1]))
         fp = fixed_points
-        self.xf = tensor(fp[0])
-        self.yf = tensor(fp[1])
+        self.register_buffer('xf', tensor(fp[0]))
+        self.register_buffer('yf', tensor(fp[1]))
 
         self.fixed_h = fixed_h
         if fixed_h:
@@ -110,6 +112,13 @@ class Shift2D(nn.Module):
         else:
             self.h = nn.Parameter(dx*torch.ones(n))
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kw):
+        # Models saved before the fixed nodes were recorded do not have them,
+        # keep the fixed nodes of the problem for those.
+        state_dict.setdefault(prefix + 'xf', self.xf)
+        state_dict.setdefault(prefix + 'yf', self.yf)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kw)
+
     def centers(self):
         return torch.cat((self.x, self.xf)), torch.cat((self.y, self.yf))
 
@@ -130,8 +139,13 @@ class Shift2D(nn.Module):
 class SPINN2D(nn.Module):
     @classmethod
     def from_args(cls, pde, activation, args):
-        return cls(pde, activation,
-                   fixed_h=args.fixed_h, use_pu=args.pu)
+        nn = cls(pde, activation,
+                 fixed_h=args.fixed_h, use_pu=args.pu,
+                 sparse=args.sparse, cutoff=args.cutoff,
+                 closed_form=args.closed_form, separable=args.separable)
+        if args.init_from:
+            nn.init_from(args.init_from, pde)
+        return nn
 
     @classmethod
     def setup_argparse(cls, parser, **kw):
@@ -144,12 +158,53 @@ class SPINN2D(nn.Module):
             '--pu', dest='pu', action='store_true', default=False,
             help='Use a partition of unity.'
         )
+        p.add_argument(
+            '--sparse', dest='sparse', action='store_true',
+            default=kw.get('sparse', False),
+            help='Only evaluate sample/node pairs within the cutoff radius '
+            '(only sensible for rapidly decaying activations).'
+        )
+        p.add_argument(
+            '--cutoff', dest='cutoff', type=float,
+            default=kw.get('cutoff', 4.0),
+            help='Cutoff radius in units of the node width for --sparse.'
+        )
+        p.add_argument(
+            '--closed-form', dest='closed_form', action='store_true',
+            default=kw.get('closed_form', False),
+            help='Compute the derivatives of the solution analytically '
+            '(gaussian and softplus activations only).'
+        )
+        p.add_argument(
+            '--separable', dest='separable', action='store_true',
+            default=kw.get('separable', False),
+            help='Evaluate grid samples using the 1D factors of a separable '
+            'activation (gaussian only).'
+        )
+        p.add_argument(
+            '--init-from', dest='init_from',
+            default=kw.get('init_from', None),
+            help='Initialize from a saved model.pt that may have a different '
+            'number of nodes.'
+        )
 
-    def __init__(self, pde, activation, fixed_h=False, use_pu=False):
+    def __init__(self, pde, activation, fixed_h=False, use_pu=False,
+                 sparse=False, cutoff=4.0, closed_form=False,
+                 separable=False):
         super().__init__()
 
+        if closed_form and not hasattr(activation, 'derivatives'):
+            raise ValueError(
+                'Activation does not support closed form derivatives.'
+            )
+        if separable and not hasattr(activation, 'factors'):
+            raise ValueError('Activation is not separable.')
+        self.separable = separable
         self.activation = activation
         self.use_pu = use_pu
+        self.sparse = sparse
+        self.cutoff = cutoff
+        self.closed_form = closed_form
         self.layer1 = Shift2D(pde.nodes(), pde.fixed_nodes(),
                               fixed_h=fixed_h)
         n = self.layer1.n
@@ -158,7 +213,156 @@ class SPINN2D(nn.Module):
         if not self.use_pu:
             self.layer2.bias.data.fill_(0.0)
 
+    def _neighbors(self, x, y):
+        '''Return the (sample, node) index pairs that lie within the cutoff
+        radius of each node.
+
+        The nodes are binned into a cell list whose cell size is the largest
+        cutoff radius so only the 3x3 block of cells around a sample needs to
+        be searched.
+        '''
+        with torch.no_grad():
+            xc, yc = self.centers()
+            rc = self.cutoff*torch.abs(self.widths())
+            cell = rc.max()
+            x0 = torch.min(xc.min(), x.min())
+            y0 = torch.min(yc.min(), y.min())
+            ncx = int(((torch.max(xc.max(), x.max()) - x0)/cell).item()) + 1
+            ncy = int(((torch.max(yc.max(), y.max()) - y0)/cell).item()) + 1
+
+            # Sort the nodes by their cell.
+            key = ((xc - x0)/cell).long()*ncy + ((yc - y0)/cell).long()
+            key, order = torch.sort(key)
+            count = torch.bincount(key, minlength=ncx*ncy)
+            start = torch.cumsum(count, 0) - count
+
+            # Candidate nodes from the neighboring cells of each sample.
+            sx = ((x - x0)/cell).long()
+            sy = ((y - y0)/cell).long()
+            off = torch.arange(-1, 2, device=x.device)
+            cx = (sx.unsqueeze(1) + off).unsqueeze(2)
+            cy = (sy.unsqueeze(1) + off).unsqueeze(1)
+            valid = (cx >= 0) & (cx < ncx) & (cy >= 0) & (cy < ncy)
+            c = torch.where(valid, cx*ncy + cy, 0).reshape(len(x), 9)
+            cnt = torch.where(valid.reshape(len(x), 9), count[c], 0)
+            m = int(count.max().item())
+            slot = torch.arange(m, device=x.device)
+            mask = slot < cnt.unsqueeze(2)
+            cand = (start[c].unsqueeze(2) + slot)[mask]
+            i = torch.arange(len(x), device=x.device).reshape(-1, 1, 1)
+            i = i.expand(mask.shape)[mask]
+            j = order[cand]
+
+            # Keep only the pairs inside the node's cutoff radius.
+            d2 = (x[i] - xc[j])**2 + (y[i] - yc[j])**2
+            inside = d2 < rc[j]**2
+            return i[inside], j[inside]
+
+    def _scaled(self, x, y, idx):
+        '''Return the scaled coordinates and node widths for either all the
+        sample/node pairs (`idx` is None) or the given index pairs.
+        '''
+        if idx is None:
+            xh, yh = self.layer1(x.unsqueeze(1), y.unsqueeze(1))
+            return xh, yh, self.layer1.h
+        i, j = idx
+        xc, yc = self.centers()
+        h = self.widths()[j]
+        return (x[i] - xc[j])/h, (y[i] - yc[j])/h, h
+
+    def _contract(self, z, idx, n_s, w):
+        if idx is None:
+            return z @ w
+        i, j = idx
+        return torch.zeros(
+            (n_s, w.shape[1]), dtype=z.dtype, device=z.device
+        ).index_add(0, i, w[j]*z.unsqueeze(1))
+
+    def _combine(self, zs, idx, n_s):
+        '''Combine the basis values and (optionally) their derivatives
+        `zs = (z, zx, zy, zxx, zyy)` into the output and its derivatives.
+        '''
+        w = self.layer2.weight.T
+        nr = [self._contract(z, idx, n_s, w) for z in zs]
+        dnr = None
+        if self.use_pu:
+            one = torch.ones_like(w[:, :1])
+            dnr = [self._contract(z, idx, n_s, one) for z in zs]
+            if idx is not None:
+                dnr[0] = dnr[0].clamp_min(1e-30)
+        return self._assemble(nr, dnr)
+
+    def _assemble(self, nr, dnr):
+        '''Given the weighted sums of the basis (and derivatives) `nr` and
+        the unweighted ones `dnr` for the partition of unity, return the
+        output and its derivatives.
+        '''
+        if not self.use_pu:
+            nr[0] = nr[0] + self.layer2.bias
+            return [t.squeeze() for t in nr]
+
+        u = nr[0]/dnr[0]
+        result = [u]
+        if len(nr) > 1:
+            # Quotient rule for u = nr/dnr.
+            for k in (1, 2):
+                result.append((nr[k] - u*dnr[k])/dnr[0])
+            for k in (3, 4):
+                du, ddnr = result[k - 2], dnr[k - 2]
+                result.append(
+                    (nr[k] - 2.0*du*ddnr - u*dnr[k])/dnr[0]
+                )
+        return [t.squeeze() for t in result]
+
+    def _forward_sparse(self, x, y):
+        idx = self._neighbors(x, y)
+        xh, yh, h = self._scaled(x, y, idx)
+        z = self.activation(xh, yh)
+        return self._combine([z], idx, len(x))[0]
+
+    def derivatives(self, x, y):
+        '''Return (u, u_x, u_y, u_xx, u_yy) at the given points computed
+        from the analytical derivatives of the activation.
+        '''
+        idx = self._neighbors(x, y) if self.sparse else None
+        xh, yh, h = self._scaled(x, y, idx)
+        z, zx, zy, zxx, zyy = self.activation.derivatives(xh, yh)
+        fac = 1.0/h
+        fac2 = fac*fac
+        zs = [z, zx*fac, zy*fac, zxx*fac2, zyy*fac2]
+        return tuple(self._combine(zs, idx, len(x)))
+
+    def grid_derivatives(self, xg, yg):
+        '''Return (u, u_x, u_y, u_xx, u_yy) on the tensor product grid of the
+        axes `xg` and `yg`, flattened in the same order as `np.mgrid`.
+
+        This requires a separable activation, z(x, y) = f(x) f(y), so that
+        only the 1D factors need to be evaluated per axis and the grid values
+        are obtained by contracting them over the nodes.
+        '''
+        xc, yc = self.centers()
+        fac = 1.0/self.widths()
+        fx, fx1, fx2 = self.activation.factors((xg.unsqueeze(1) - xc)*fac)
+        fy, fy1, fy2 = self.activation.factors((yg.unsqueeze(1) - yc)*fac)
+        fx1, fy1 = fx1*fac, fy1*fac
+        fx2, fy2 = fx2*fac*fac, fy2*fac*fac
+        pairs = ((fx, fy), (fx1, fy), (fx, fy1), (fx2, fy), (fx, fy2))
+
+        def _contract(a, b, w):
+            c = (a.unsqueeze(2)*w).permute(2, 0, 1) @ b.T
+            return c.reshape(w.shape[1], -1).T
+
+        w = self.layer2.weight.T
+        nr = [_contract(a, b, w) for a, b in pairs]
+        dnr = None
+        if self.use_pu:
+            one = torch.ones_like(w[:, :1])
+            dnr = [_contract(a, b, one) for a, b in pairs]
+        return tuple(self._assemble(nr, dnr))
+
     def forward(self, x, y):
+        if self.sparse:
+            return self._forward_sparse(x, y)
         x = x.unsqueeze(1)
         y = y.unsqueeze(1)
         xh, yh = self.layer1(x, y)
@@ -179,11 +383,132 @@ class SPINN2D(nn.Module):
     def weights(self):
         return self.layer2.weight
 
+    def linear_parameters(self):
+        return self.layer2.parameters()
+
+    def shift_time(self, dt):
+        '''Move all the nodes by `dt` along the second coordinate, which is
+        time for the space-time problems.
+        '''
+        l1 = self.layer1
+        with torch.no_grad():
+            l1.y += dt
+            l1.yf += dt
+
+    def init_from(self, fname, pde):
+        '''Initialize from the model saved in `fname` which may have a
+        different number of nodes.
+
+        The centers are left as they are, each node takes the width of the
+        nearest saved node scaled by the ratio of the node spacings, and the
+        weights are the least squares fit to the saved solution on a grid
+        spanning the plot points of the `pde` with at least four points per
+        node.
+        '''
+        coarse = copy.deepcopy(self)
+        load_resized(coarse, torch.load(fname, map_location=device()))
+        l1, cl1 = self.layer1, coarse.layer1
+        # load_resized only replaces the tensors so set the node count.
+        cl1.n = coarse.layer2.in_features = len(cl1.x) + len(cl1.xf)
+        with torch.no_grad():
+            for name, value in coarse.state_dict().items():
+                dest = self.state_dict()[name]
+                if value.shape == dest.shape and not name.startswith('layer'):
+                    dest.copy_(value)
+            fac = np.sqrt(cl1.n/l1.n)
+            if l1.fixed_h:
+                l1.h.copy_(cl1.h*fac)
+            else:
+                xc, yc = cl1.centers()
+                x, y = l1.centers()
+                d = (x.unsqueeze(1) - xc)**2 + (y.unsqueeze(1) - yc)**2
+                l1.h.copy_(cl1.h[torch.argmin(d, dim=1)]*fac)
+
+        # Fit on enough points to determine the weights of all the nodes.
+        xp, yp = (np.asarray(v) for v in pde.plot_points())
+        m = max(int(np.sqrt(xp.size)), int(np.ceil(2.0*np.sqrt(l1.n))))
+        x, y = np.mgrid[
+            xp.min():xp.max():m*1j, yp.min():yp.max():m*1j
+        ]
+        x, y = tensor(x.ravel()), tensor(y.ravel())
+        with torch.no_grad():
+            uc = coarse(x, y)
+        loss = ((self(x, y) - uc)**2).mean()
+        minimize_quadratic(loss, list(self.layer2.parameters()))
+
+    def _resize_nodes(self, index, x=None, y=None, h=None, w=None,
+                      optimizer=None):
+        l1 = self.layer1
+        n_free = len(l1.x)
+        fixed = torch.arange(n_free, l1.n, device=index.device)
+        full = torch.cat((index, fixed))
+        resize_parameter(l1.x, index, x, optimizer=optimizer)
+        resize_parameter(l1.y, index, y, optimizer=optimizer)
+        if not l1.fixed_h:
+            resize_parameter(l1.h, full, h, optimizer=optimizer)
+        resize_parameter(
+            self.layer2.weight, full, w, dim=1, optimizer=optimizer
+        )
+        l1.n = self.layer2.in_features = len(full)
+
+    def remove_nodes(self, keep, optimizer=None):
+        '''Remove the free nodes that are False in the mask `keep` which is
+        given for all the nodes.  Fixed nodes are never removed.
+        '''
+        n_free = len(self.layer1.x)
+        index = torch.nonzero(keep[:n_free]).squeeze(1)
+        self._resize_nodes(index, optimizer=optimizer)
+
+    def removal_change(self, x, y):
+        '''Return the root mean square change of the solution at the points
+        (`x`, `y`) when each node is removed by itself.
+        '''
+        with torch.no_grad():
+            xh, yh = self.layer1(x.unsqueeze(1), y.unsqueeze(1))
+            z = self.activation(xh, yh)
+            return removal_change(z, self.layer2.weight.T, self.use_pu)
+
+    def insert_nodes(self, x, y, optimizer=None):
+        '''Insert free nodes at (`x`, `y`) with the width of the nearest
+        existing node.  Their weight is zero, or the current solution at the
+        points with a partition of unity so that the solution changes little.
+        '''
+        with torch.no_grad():
+            xc, yc = self.centers()
+            h = self.widths()
+            d = (x.unsqueeze(1) - xc)**2 + (y.unsqueeze(1) - yc)**2
+            hn = h[torch.argmin(d, dim=1)]
+            wn = self(x, y).reshape(len(x), -1).T if self.use_pu else None
+        n_free = len(self.layer1.x)
+        index = torch.cat((
+            torch.arange(n_free, device=x.device),
+            -torch.ones(len(x), dtype=torch.long, device=x.device)
+        ))
+        self._resize_nodes(index, x, y, hn, wn, optimizer=optimizer)
+
 
 def gaussian(x, y):
     return torch.exp(-0.5*(x*x + y*y))
 
 
+class Gaussian:
+    def __call__(self, x, y):
+        return gaussian(x, y)
+
+    def derivatives(self, x, y):
+        '''Return the activation and its x, y, xx and yy derivatives.
+        '''
+        z = gaussian(x, y)
+        return z, -x*z, -y*z, (x*x - 1.0)*z, (y*y - 1.0)*z
+
+    def factors(self, x):
+        '''Return the 1D factor of the activation, exp(-x^2/2), and its
+        first and second derivatives.
+        '''
+        z = torch.exp(-0.5*x*x)
+        return z, -x*z, (x*x - 1.0)*z
+
+
 class SoftPlus:
     def __init__(self):
         self._sp = nn.Softplus()
@@ -196,6 +521,22 @@ class SoftPlus:
             self.k - sp(2.0*x) - sp(-2.0*x) - sp(2.0*y) - sp(-2.0*y)
         )/self.fac
 
+    def derivatives(self, x, y):
+        '''Return the activation and its x, y, xx and yy derivatives.
+        '''
+        sp = self._sp
+        sx, sy = torch.sigmoid(2.0*x), torch.sigmoid(2.0*y)
+        g = self.k - sp(2.0*x) - sp(-2.0*x) - sp(2.0*y) - sp(-2.0*y)
+        gx, gy = 2.0 - 4.0*sx, 2.0 - 4.0*sy
+        gxx, gyy = -8.0*sx*(1.0 - sx), -8.0*sy*(1.0 - sy)
+        s = torch.sigmoid(g)
+        ds = s*(1.0 - s)
+        fac = self.fac
+        return (
+            sp(g)/fac, s*gx/fac, s*gy/fac,
+            (ds*gx*gx + s*gxx)/fac, (ds*gy*gy + s*gyy)/fac
+        )
+
 
 class RBFNNKernel(nn.Module):
     def __init__(self, n_kernel, activation=torch.tanh):
@@ -206,9 +547,23 @@ class RBFNNKernel(nn.Module):
         self.layer1 = nn.Linear(1, n_kernel)
         self.layer2 = nn.Linear(n_kernel, n_kernel)
         self.layer3 = nn.Linear(n_kernel, 1)
+        self.table = None
+
+    def tabulate(self, size, extent):
+        '''Evaluate the kernel from a table of `size` values of the squared
+        radius up to `extent**2` that is rebuilt once per parameter update.
+        '''
+        self.table = KernelTable(
+            self._radial, self.parameters, 0.0, extent*extent, size
+        )
 
     def forward(self, x, y):
         r = x*x + y*y
+        if self.table is not None:
+            return self.table(r)
+        return self._radial(r)
+
+    def _radial(self, r):
         act = self.activation
         orig_shape = r.shape
         r = r.flatten().unsqueeze(1)
@@ -256,12 +611,27 @@ class App2D(App):
             default=kw.get('kernel_size', 10), type=int,
             help='Activation kernel size (in place of a Gaussian).'
         )
+        p.add_argument(
+            '--kernel-table', dest='kernel_table',
+            default=kw.get('kernel_table', 0), type=int,
+            help='Tabulate the radial kernel activation using these many '
+            'points (0 evaluates the kernel network directly).'
+        )
+        p.add_argument(
+            '--kernel-range', dest='kernel_range',
+            default=kw.get('kernel_range', 5.0), type=float,
+            help='Initial extent of the kernel table in units of the node '
+            'width.'
+        )
 
     def _get_activation(self, args):
         activations = {
-            'gaussian': lambda x: gaussian,
+            'gaussian': lambda x: Gaussian(),
             'softplus': lambda x: SoftPlus(),
             'kernel': RBFNNKernel,
             'nnkernel': NNKernel
         }
-        return activations[args.activation](args.kernel_size)
+        activation = activations[args.activation](args.kernel_size)
+        if args.kernel_table > 0 and args.activation == 'kernel':
+            activation.tabulate(args.kernel_table, args.kernel_range)
+        return activation
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules in code/ are imported as top level modules by the scripts.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,39 @@
+import pytest
+import torch
+
+from ode1 import ODESimple
+from spinn1d import SPINN1D, Gaussian
+
+
+def _net(use_pu):
+    torch.manual_seed(0)
+    nn = SPINN1D(ODESimple(10, 40), Gaussian(), use_pu=use_pu)
+    with torch.no_grad():
+        nn.layer2.weight.copy_(torch.sin(3.0*nn.centers()))
+    return nn
+
+
+@pytest.mark.parametrize('use_pu', [False, True])
+def test_removal_change_is_change_of_solution(use_pu):
+    nn = _net(use_pu)
+    x = torch.linspace(0.0, 1.0, 101)
+    change = nn.removal_change(x)
+    with torch.no_grad():
+        u = nn(x)
+        keep = torch.ones(nn.layer1.n, dtype=torch.bool)
+        keep[3] = False
+        nn.remove_nodes(keep)
+        du = nn(x) - u
+    assert torch.allclose(change[3], du.pow(2).mean().sqrt(), rtol=1e-4)
+
+
+def test_pu_insertion_keeps_the_solution():
+    nn = _net(True)
+    x = torch.linspace(0.0, 1.0, 101)
+    n = nn.layer1.n
+    with torch.no_grad():
+        u = nn(x)
+        nn.insert_nodes(torch.tensor([0.33, 0.71]))
+        du = nn(x) - u
+    assert nn.layer1.n == n + 2
+    assert du.abs().max() < 0.1*u.abs().max()
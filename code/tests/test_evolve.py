@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import torch
+
+from common import Optimizer
+from fd_spinn1d_base import AppFD1D, FDPlotter1D
+from heat1d_fd_spinn import Heat1D
+from spinn1d import SPINN1D, Gaussian
+
+
+def _evolve_heat(damping, n_steps):
+    torch.manual_seed(0)
+    pde = Heat1D(20, 100, dt=1e-3, evolve='euler', evolve_damping=damping)
+    nn = SPINN1D(pde, Gaussian())
+    app = AppFD1D(Heat1D, SPINN1D, FDPlotter1D)
+    app.pde, app.nn = pde, nn
+    # Fit the initial condition.
+    pde.c, pde.dt_eff = pde.u0, 0.0
+    Optimizer(pde, nn, None, 1, plot=False).step_linear()
+    for i in range(n_steps):
+        app.evolve_step()
+    x = np.linspace(0.0, 1.0, 101)
+    with torch.no_grad():
+        u = nn(torch.tensor(x, dtype=torch.float32)).numpy()
+    return np.abs(u - pde.exact(x)).max()
+
+
+@pytest.mark.parametrize('damping, stable', [(1e-2, True), (0.0, False)])
+def test_evolve_heat_stays_close_to_exact(damping, stable):
+    err = _evolve_heat(damping, 20)
+    assert (err < 0.05) == stable
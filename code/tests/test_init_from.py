@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+
+from ode1 import ODESimple
+from spinn1d import SPINN1D, Gaussian
+
+
+def test_warm_start_1d_scales_widths(tmp_path):
+    coarse = SPINN1D(ODESimple(5, 20), Gaussian())
+    with torch.no_grad():
+        coarse.layer1.h.fill_(0.3)
+    fname = str(tmp_path / 'model.pt')
+    torch.save(coarse.state_dict(), fname)
+
+    pde = ODESimple(20, 40)
+    fine = SPINN1D(pde, Gaussian())
+    fine.init_from(fname, pde)
+    n, n_c = fine.layer1.n, coarse.layer1.n
+    assert n > n_c
+    assert torch.allclose(fine.layer1.h, torch.full((n,), 0.3*n_c/n))
+
+
+def test_warm_start_2d_scales_widths(tmp_path):
+    pytest.importorskip('mayavi')
+    from poisson2d_sine import Poisson2D
+    from spinn2d import SPINN2D, gaussian
+
+    coarse = SPINN2D(Poisson2D(9, 100), gaussian)
+    with torch.no_grad():
+        coarse.layer1.h.fill_(0.3)
+    fname = str(tmp_path / 'model.pt')
+    torch.save(coarse.state_dict(), fname)
+
+    pde = Poisson2D(36, 100)
+    fine = SPINN2D(pde, gaussian)
+    fine.init_from(fname, pde)
+    n, n_c = fine.layer1.n, coarse.layer1.n
+    assert n > n_c
+    h = torch.full((n,), 0.3*np.sqrt(n_c/n))
+    assert torch.allclose(fine.layer1.h, h)
+
+
+def test_warm_start_1d_fits_more_nodes_than_plot_points(tmp_path):
+    torch.manual_seed(0)
+    coarse = SPINN1D(ODESimple(5, 20), Gaussian())
+    with torch.no_grad():
+        coarse.layer2.weight.uniform_(-1.0, 1.0)
+    fname = str(tmp_path / 'model.pt')
+    torch.save(coarse.state_dict(), fname)
+
+    pde = ODESimple(40, 80)
+    fine = SPINN1D(pde, Gaussian())
+    assert fine.layer1.n > len(pde.plot_points())
+    fine.init_from(fname, pde)
+    # Away from the gaps left next to the fixed nodes.
+    x = torch.linspace(0.2, 0.8, 1001)
+    with torch.no_grad():
+        assert (fine(x) - coarse(x)).abs().max() < 0.1
+
+
+def test_load_model_saved_without_fixed_nodes():
+    pde = ODESimple(5, 20)
+    nn = SPINN1D(pde, Gaussian())
+    state = nn.state_dict()
+    del state['layer1.fixed']
+    other = SPINN1D(pde, Gaussian())
+    other.load_state_dict(state)
+    assert torch.equal(other.centers(), nn.centers())
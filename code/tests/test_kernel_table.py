@@ -0,0 +1,54 @@
+import torch
+
+from common import PDE, _has_no_storage, func_derivatives, is_transformed
+from spinn1d import Kernel
+
+
+def _kernel(size=0):
+    torch.manual_seed(0)
+    k = Kernel(5)
+    if size > 0:
+        k.tabulate(size, 2.0)
+    return k
+
+
+def test_func_derivatives_of_tabulated_kernel():
+    exact, table = _kernel(), _kernel(256)
+    # Extends beyond the initial range of the table.
+    x = torch.linspace(-3.0, 3.0, 41)
+    result = func_derivatives(table, x)
+    assert table.table.lo < -3.0 and table.table.hi > 3.0
+
+    xs = x.requires_grad_(True)
+    expect = PDE()._compute_derivatives(exact(xs), xs)
+    for a, b in zip(result, expect):
+        assert torch.allclose(a, b.detach(), atol=1e-2)
+
+
+def test_jacfwd_of_tabulated_kernel_parameters():
+    exact, table = _kernel(), _kernel(512)
+    x = torch.linspace(-1.0, 1.0, 11)
+    table(x)
+
+    def jacobian(k):
+        names, params = zip(*k.named_parameters())
+
+        def output(p):
+            return torch.func.functional_call(k, dict(zip(names, p)), (x,))
+
+        return torch.func.jacfwd(output)(tuple(p.detach() for p in params))
+
+    for a, b in zip(jacobian(table), jacobian(exact)):
+        assert torch.allclose(a, b, atol=1e-4)
+
+
+def test_is_transformed_fallback():
+    x = torch.ones(3)
+    assert not is_transformed(x) and not _has_no_storage(x)
+
+    def check(z):
+        assert is_transformed(z) and _has_no_storage(z)
+        return z.sum()
+
+    torch.func.grad(check)(x)
+    torch.func.vmap(check)(x)
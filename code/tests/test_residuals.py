@@ -0,0 +1,44 @@
+import importlib
+from argparse import ArgumentParser
+
+import pytest
+import torch
+
+
+CASES = [
+    ('ode1', 'ODESimple', False),
+    ('ode2', 'Neumann1D', False),
+    ('ode3', 'ODESimple', False),
+    ('heat1d_fd_spinn', 'Heat1D', False),
+    ('advection1d_fd_spinn', 'Advection1D', False),
+    ('burgers1d_fd_spinn', 'Burgers1D', False),
+    ('poisson2d_sine', 'Poisson2D', True),
+    ('poisson2d_pulse', 'Poisson2D', True),
+    ('poisson2d_square_slit', 'SquareSlit', True),
+    ('cavity', 'CavityPDE', True),
+    ('heat1d', 'Heat1D', True),
+    ('advection1d', 'Advection1D', True),
+    ('burgers1d', 'Burgers1D', True),
+]
+
+
+@pytest.mark.parametrize('module, name, two_d', CASES)
+def test_residuals_sum_of_squares_is_loss(module, name, two_d):
+    if two_d:
+        pytest.importorskip('mayavi')
+        from spinn2d import SPINN2D as nn_cls, gaussian as activation
+    else:
+        from spinn1d import SPINN1D as nn_cls, Gaussian
+        activation = Gaussian()
+    pde_cls = getattr(importlib.import_module(module), name)
+    p = ArgumentParser()
+    pde_cls.setup_argparse(p)
+    nn_cls.setup_argparse(p)
+    args = p.parse_args([])
+
+    torch.manual_seed(0)
+    pde = pde_cls.from_args(args)
+    nn = nn_cls.from_args(pde, activation, args)
+    r = pde.residuals(nn)
+    assert r.dim() == 1
+    assert torch.allclose((r**2).sum(), pde.loss(nn), rtol=1e-5)
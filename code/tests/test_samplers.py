@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+from samplers import BatchSampler
+
+
+@pytest.mark.parametrize('mode', ['epoch', 'sobol'])
+def test_batches_cover_an_epoch_once(mode):
+    s = BatchSampler(100, 25, mode, seed=1)
+    idx = torch.cat([s.draw() for _ in range(4)])
+    assert torch.equal(torch.sort(idx).values, torch.arange(100))
+
+
+@pytest.mark.parametrize('mode', ['epoch', 'sobol'])
+def test_restore_state(mode, tmp_path):
+    s = BatchSampler(100, 30, mode, seed=1)
+    s.draw()
+    fname = str(tmp_path / 'sampler.pt')
+    torch.save(s.state_dict(), fname)
+    expect = [s.draw() for _ in range(5)]
+
+    r = BatchSampler(1, 1)
+    r.load_state_dict(torch.load(fname, weights_only=True))
+    for e in expect:
+        assert torch.equal(r.draw(), e)
@@ -9,4 +9,9 @@ class Var1D(BasicODE):
 
     def interior_loss(self, nn):
         res = self._get_residue(nn)
-        return res.mean()
+        return self.sample_weighted(res).mean()
+
+    def interior_residuals(self, nn):
+        raise NotImplementedError(
+            'The variational loss is not a sum of squares.'
+        )
@@ -92,6 +92,9 @@ class Wavelet1D(nn.Module):
         x = self.layer2(x)
         return x.squeeze()
 
+    def linear_parameters(self):
+        return self.layer2.parameters()
+
 
 class WaveletPlotter1D(Plotter1D):
     def plot_weights(self):